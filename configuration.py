@@ -17,6 +17,19 @@ def get_indelible_config():
 
 	return indelible_config
 
+# Column order of the summary statistics in SpartaABC posterior_params / stats files.
+SUMMARY_STATS_COLS = ['AVG_GAP_SIZE', 'MSA_LEN', 'MSA_MAX_LEN', 'MSA_MIN_LEN', 'TOT_NUM_GAPS',
+					  'NUM_GAPS_LEN_ONE', 'NUM_GAPS_LEN_TWO', 'NUM_GAPS_LEN_THREE', 'NUM_GAPS_LEN_AT_LEAST_FOUR',
+					  'AVG_UNIQUE_GAP_SIZE', 'TOT_NUM_UNIQE_GAPS',
+					  'NUM_GAPS_LEN_ONE_POS_1_GAPS', 'NUM_GAPS_LEN_ONE_POS_2_GAPS', 'NUM_GAPS_LEN_ONE_POS_N_MINUS_1_GAPS',
+					  'NUM_GAPS_LEN_TWO_POS_1_GAPS', 'NUM_GAPS_LEN_TWO_POS_2_GAPS', 'NUM_GAPS_LEN_TWO_POS_N_MINUS_1_GAPS',
+					  'NUM_GAPS_LEN_THREE_POS_1_GAPS', 'NUM_GAPS_LEN_THREE_POS_2_GAPS', 'NUM_GAPS_LEN_THREE_POS_N_MINUS_1_GAPS',
+					  'NUM_GAPS_LEN_AT_LEAST_FOUR_POS_1_GAPS', 'NUM_GAPS_LEN_AT_LEAST_FOUR_POS_2_GAPS',
+					  'NUM_GAPS_LEN_AT_LEAST_FOUR_POS_N_MINUS_1_GAPS',
+					  'MSA_POSITION_WITH_0_GAPS', 'MSA_POSITION_WITH_1_GAPS', 'MSA_POSITION_WITH_2_GAPS',
+					  'MSA_POSITION_WITH_N_MINUS_1_GAPS']
+PARAMS_COLS = ['RL', 'AIR', 'ADR', 'IR', 'DR']
+
 def get_sparta_config():
 	sparta_config = OrderedDict()
 
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Correction models of the msa bias correction.
+
+A correction model maps the (standardized) indel parameters and statistics of
+the true alignments to the statistics of their realignments, one linear
+regression per statistic. All statistics are fitted in one call:
+	lasso - LassoCV per statistic: the regularization path of every fold is solved by
+	        coordinate descent with warm starts, instead of one cold Lasso fit per
+	        (alpha, fold) pair. Statistics are fitted in parallel with joblib.
+	ridge - a single multi-output RidgeCV with one alpha per statistic, whose
+	        leave-one-out errors come in closed form for all statistics and alphas at once.
+Both report, per statistic, the Pearson correlation of the fitted values with
+the realignment statistics (what filter_p thresholds) and the cross-validated RMSE.
+
+Fitted corrections can be saved to a model store ($SPARTA_MODEL_DIR, default
+~/.cache/sparta/correction_models, opt-in with skip_config['save_correction']),
+keyed by mode, substitution model, realigner, correction method, tree size bucket,
+indel model and a hash of all the substitution parameters and filter_p, so that
+similar datasets can reuse them instead of realigning (skip_config['stored_correction']).
+The weights of the statistics are not stored, they come from the simulations of each dataset. Every entry is a directory written under a
+private name and renamed in one step. An existing entry is never overwritten:
+the first dataset saved under a key is the one reused, remove the entry to refit it.
+"""
+
+import os
+import json
+import time
+import hashlib
+import uuid
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn import linear_model
+
+import summary_statistics as sstats
+
+
+ALPHAS = np.logspace(-7, 4, 20)
+CV_FOLDS = 3
+METHODS = ['lasso', 'ridge']
+# trees of up to this many taxa share stored corrections
+TREE_SIZE_BUCKETS = [4, 8, 16, 32, 64, 128, 256, 512]
+
+
+class correction_model:
+	"""
+	fitted linear models, one column of coef per statistic.
+	"""
+	def __init__(self, method, coef, intercept, alphas, cv_rmse, pearson):
+		self.method = method
+		self.coef = coef
+		self.intercept = intercept
+		self.alphas = alphas
+		self.cv_rmse = cv_rmse
+		self.pearson = pearson
+
+	def predict(self, X):
+		"""
+		(num_rows, num_statistics) predictions.
+		"""
+		return X @ self.coef + self.intercept
+
+
+def pearson_columns(a, b):
+	"""
+	Pearson correlation of every column of a with the same column of b, nan for constant columns
+	(like the predictions of a model whose coefficients are all 0).
+	"""
+	constant = (np.ptp(a, axis=0) == 0) | (np.ptp(b, axis=0) == 0)
+	a = a - a.mean(axis=0)
+	b = b - b.mean(axis=0)
+	norms = np.sqrt((a**2).sum(axis=0)*(b**2).sum(axis=0))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(~constant & (norms > 0), (a*b).sum(axis=0)/norms, np.nan)
+
+
+def _fit_lasso(X, y, alphas, cv):
+	reg = linear_model.LassoCV(alphas=alphas, cv=cv, fit_intercept=True)
+	reg.fit(X, y)
+	# rmse of the best alpha, as GridSearchCV reports it (mean of the fold mse)
+	cv_rmse = np.sqrt(reg.mse_path_.mean(axis=1).min())
+	return reg.coef_, reg.intercept_, reg.alpha_, cv_rmse
+
+
+def fit_lasso(X, Y, alphas=ALPHAS, cv=CV_FOLDS, n_jobs=-1):
+	fits = Parallel(n_jobs=n_jobs)(delayed(_fit_lasso)(X, Y[:, ind], alphas, cv) for ind in range(Y.shape[1]))
+	coef = np.column_stack([fit[0] for fit in fits])
+	intercept = np.array([fit[1] for fit in fits])
+	return coef, intercept, np.array([fit[2] for fit in fits]), np.array([fit[3] for fit in fits])
+
+
+def fit_ridge(X, Y, alphas=ALPHAS, cv=None, n_jobs=None):
+	"""
+	cv is unused, the errors are leave-one-out.
+	"""
+	reg = linear_model.RidgeCV(alphas=alphas, fit_intercept=True, store_cv_results=True, alpha_per_target=True)
+	reg.fit(X, Y)
+	# (num_rows, num_statistics, num_alphas) squared leave-one-out errors
+	cv_rmse = np.sqrt(reg.cv_results_.reshape(len(Y), Y.shape[1], len(alphas)).mean(axis=0).min(axis=1))
+	return reg.coef_.T, reg.intercept_, np.asarray(reg.alpha_), cv_rmse
+
+
+FITTERS = {'lasso': fit_lasso, 'ridge': fit_ridge}
+
+
+def fit_correction_model(X, Y, method='lasso', alphas=ALPHAS, cv=CV_FOLDS, n_jobs=-1):
+	"""
+	fits one regression per column of Y on X. Returns a correction_model.
+	"""
+	if method not in FITTERS:
+		raise ValueError(f"Error: unknown correction model {method}, choose one of {', '.join(METHODS)}.")
+	coef, intercept, best_alphas, cv_rmse = FITTERS[method](X, Y, alphas, cv, n_jobs)
+	pearson = pearson_columns(X @ coef + intercept, Y)
+	logger.info(f'fitted {method} correction models for {Y.shape[1]} statistics on {len(Y)} msas')
+	return correction_model(method, coef, intercept, best_alphas, cv_rmse, pearson)
+
+
+def standardize(X, X_train_mean, X_train_std, epsilon=1E-4):
+	X_reg = (X-X_train_mean+epsilon)/(X_train_std+epsilon)
+	X_reg[np.isnan(X_reg)] = 0
+	X_reg[X_reg == 10000000] = 0
+	return X_reg
+
+
+class bias_correction:
+	"""
+	a correction model with what applying it to a posterior table needs: the input columns and
+	their standardization, the corrected statistics, and the statistics passing the Pearson filter
+	(used_features) and those used in distances (sumstat_to_use).
+	"""
+	def __init__(self, model, train_cols, sstat_cols, x_mean, x_std, used_features=None, sumstat_to_use=None):
+		self.model = model
+		self.train_cols = list(train_cols)
+		self.sstat_cols = list(sstat_cols)
+		self.x_mean = x_mean
+		self.x_std = x_std
+		self.used_features = used_features
+		self.sumstat_to_use = sumstat_to_use
+
+	def predict(self, df):
+		"""
+		corrected statistics of the simulations of a DataFrame.
+		"""
+		return self.model.predict(standardize(df[self.train_cols].values, self.x_mean, self.x_std))
+
+
+def store_dir():
+	return os.environ.get("SPARTA_MODEL_DIR", os.path.join(os.path.expanduser('~'), '.cache', 'sparta', 'correction_models'))
+
+
+def num_taxa(tree):
+	"""
+	number of leaves of a Newick tree.
+	"""
+	return tree.count(',') + 1
+
+
+def tree_size_bucket(num_of_taxa):
+	for bucket in TREE_SIZE_BUCKETS:
+		if num_of_taxa <= bucket:
+			return bucket
+	return TREE_SIZE_BUCKETS[-1]*2
+
+
+def store_key(model_type, realignment_params, correction_method, tree, filter_p):
+	"""
+	corrections are compatible when they share the submodel_params that change realignments
+	(realignment_params: mode, substitution model and its rates, frequencies, invariant sites and gamma,
+	simulator and realigner), the method, the tree size bucket, the indel model and filter_p, which
+	selects the stored sumstat_to_use. The readable part of the key is followed by a hash of all of them.
+	"""
+	submodel = realignment_params.get("submodel", "WAG") if realignment_params["mode"] == "nuc" else "WAG"
+	digest = hashlib.sha256(json.dumps({'params': realignment_params, 'filter_p': list(filter_p)},
+									   sort_keys=True).encode()).hexdigest()
+	return "_".join([realignment_params["mode"], submodel,
+					 realignment_params.get("realigner", "mafft"), correction_method,
+					 f'taxa{tree_size_bucket(num_taxa(tree))}', model_type, digest[:16]])
+
+
+def entry_path(key):
+	return os.path.join(store_dir(), key)
+
+
+def save_correction(key, correction):
+	"""
+	saves the correction under key, unless the store already has an entry for it.
+	Returns True when it was saved.
+	"""
+	path = entry_path(key)
+	if os.path.isdir(path):
+		logger.info(f'{path} already exists, not overwritten')
+		return False
+	os.makedirs(store_dir(), exist_ok=True)
+	# private to this run, parallel runs saving the same key never share files
+	tmp_path = f'{path}.tmp{os.getpid()}.{uuid.uuid4().hex}'
+	os.makedirs(tmp_path)
+	model = correction.model
+	try:
+		np.savez(os.path.join(tmp_path, 'model.npz'), coef=model.coef, intercept=model.intercept, alphas=model.alphas,
+				 cv_rmse=model.cv_rmse, pearson=model.pearson, x_mean=correction.x_mean, x_std=correction.x_std)
+		with open(os.path.join(tmp_path, 'correction.json'), 'w') as f:
+			json.dump({'method': model.method,
+					   'train_cols': correction.train_cols,
+					   'sstat_cols': correction.sstat_cols,
+					   'used_features': correction.used_features,
+					   'sumstat_to_use': correction.sumstat_to_use,
+					   'stats_version': sstats.STATS_VERSION,
+					   'created': time.strftime('%Y-%m-%dT%H:%M:%S')}, f)
+		# fails when another run saved the key first
+		os.rename(tmp_path, path)
+	except OSError as e:
+		shutil.rmtree(tmp_path, ignore_errors=True)
+		logger.info(f'correction models not saved to {path}: {e}')
+		return False
+	logger.info(f'saved the correction models to {path}')
+	return True
+
+
+def load_correction(key):
+	"""
+	the stored bias_correction of the key, or None when there is no compatible one.
+	"""
+	path = entry_path(key)
+	if not os.path.isfile(os.path.join(path, 'correction.json')):
+		return None
+	with open(os.path.join(path, 'correction.json')) as f:
+		info = json.load(f)
+	if info['stats_version'] != sstats.STATS_VERSION:
+		logger.info(f'{path} was fitted on other summary statistics, not used')
+		return None
+	arrays = np.load(os.path.join(path, 'model.npz'))
+	model = correction_model(info['method'], arrays['coef'], arrays['intercept'], arrays['alphas'],
+							 arrays['cv_rmse'], arrays['pearson'])
+	return bias_correction(model, info['train_cols'], info['sstat_cols'], arrays['x_mean'], arrays['x_std'],
+						   info['used_features'], info['sumstat_to_use'])
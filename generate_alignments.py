@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of simulated training samples for any number of taxa.
+
+Every sample is a random tree, a true alignment simulated along it under the
+SpartaABC indel model with parameters drawn from the priors, substitutions
+added by INDELible (or the native simulators) and the summary statistics of
+the alignment. Samples are streamed to a sink:
+	text   - the 'all_data_<start>_<end>' shards of the for_edo scripts
+	binary - sample_shards directories ('all_data_<start>_<end>.shard')
+	stdout - the text layout, on standard output
+
+State that does not change between samples (SpartaABC config, scratch
+directory, substitution model) is set up once per sample range, and
+substitutions are simulated for a whole batch of samples at once.
+Text and binary sinks split the work with parallel_generation and can be resumed.
+
+usage: python generate_alignments.py <data_set_path> --num-taxa 10 --mode nuc --num-samples 1000 [options]
+"""
+
+import os
+import sys
+import random
+import functools
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from configuration import get_sparta_config
+import tree_sampler
+import indel_simulator as isim
+import msa_bias_corrector as corrector
+import summary_statistics as sstats
+import parallel_generation as pgen
+import sample_shards
+import tool_runner
+
+
+# submodel_params of the for_edo scripts.
+SUBMODEL_PARAMS = {
+	"nuc": {
+		"mode": "nuc",
+		"submodel": "GTR",
+		"freq": (0.369764, 0.165546, 0.306709, 0.157981),
+		"rates": (0.443757853, 0.084329474, 0.115502265, 0.107429571, 0.000270340),
+		"inv_prop": 0.0,
+		"gamma_shape": 99.852225,
+		"gamma_cats": 4
+	},
+	"amino": {
+		"mode": "amino"
+	}
+}
+
+NUM_OF_SAMPLES_PER_FILE = int(1e5)
+DEFAULT_SPARTA_EXEC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SpartaABC')
+
+
+class sparta_indel_backend:
+	"""
+	simulates the true alignment of a sample with a single SpartaABC simulation.
+	The config is written once, only the tree and the input msa change between samples.
+	"""
+	def __init__(self, settings, scratch_path):
+		self.settings = settings
+		self.scratch_path = scratch_path
+		self.msa_path = os.path.join(scratch_path, 'msa.fasta')
+		self.tree_path = os.path.join(scratch_path, 'tree.tree')
+		self.params_path = os.path.join(scratch_path, 'sample.posterior_params')
+		self.alignments_path = os.path.join(scratch_path, 'alignments.fasta')
+		self.conf_path = os.path.join(scratch_path, 'sample.conf')
+		self.names = tree_sampler.taxon_names(settings.num_taxa)
+
+		sparta_config = get_sparta_config()
+		sparta_config["_numSimulations"] = "1"
+		sparta_config["_numBurnIn"] = "1"
+		sparta_config["_alignments_output"] = "1"
+		sparta_config["_outputGoodParamsFile"] = self.params_path
+		sparta_config["_outputAlignmnetsFile"] = self.alignments_path
+		sparta_config["_inputRealMSAFile"] = self.msa_path
+		sparta_config["_inputTreeFileName"] = self.tree_path
+		sparta_config["_minIRVal"] = str(round(settings.min_ir,2))
+		sparta_config["_maxIRVal"] = str(round(settings.max_ir,2))
+		sparta_config["_modelType"] = settings.model_type
+		sparta_config["_minAVal"] = settings.min_a
+		sparta_config["_maxAVal"] = settings.max_a
+		with open(self.conf_path, 'w') as fout:
+			for key in sparta_config:
+				fout.write(f'{key} {sparta_config[key]}\n')
+
+	def simulate(self, tree, seq_length, rng):
+		"""
+		returns the parameters and summary statistics (as printed by SpartaABC) and the alignment.
+		SpartaABC draws from its own random source, rng is not used.
+		"""
+		with open(self.tree_path, 'w') as f:
+			f.write(tree)
+		with open(self.msa_path, 'w') as f:
+			f.write("".join(f'>{name}\n{"T"*seq_length}\n' for name in self.names))
+		tool_runner.run_tool([self.settings.sparta_exec, self.conf_path], cwd=self.scratch_path, capture_output=False)
+
+		with open(self.params_path, 'r') as f:
+			values = f.readlines()[4].rstrip('\n').split('\t')[1:]
+		align_list, _ = corrector.parse_alignments_file(self.alignments_path)
+		return values[:5], values[5:], align_list[0]
+
+
+class native_indel_backend:
+	"""
+	simulates the true alignment of a sample with indel_simulator, under the same priors
+	SpartaABC derives from an input msa of seq_length residues per taxon.
+	"""
+	def __init__(self, settings, scratch_path):
+		self.settings = settings
+
+	def simulate(self, tree, seq_length, rng):
+		settings = self.settings
+		min_rl, max_rl = isim.rl_prior_from_msa(["T"*seq_length])
+		alignments, params = isim.simulate_alignments(tree, 1, settings.model_type, min_rl, max_rl,
+													  round(settings.min_ir,2), round(settings.max_ir,2),
+													  settings.min_a, settings.max_a, seed=rng)
+		# statistics are computed for the whole batch by generate_samples
+		return [f'{value:g}' for value in params.iloc[0].values], None, alignments[0]
+
+
+INDEL_BACKENDS = {"sparta": sparta_indel_backend, "native": native_indel_backend}
+
+
+class text_sink:
+	"""
+	one line 'params,stats,tree' per sample followed by its aligned rows.
+	"""
+	def __init__(self, out):
+		self.out = out
+
+	def write(self, params, stats, tree, rows):
+		self.out.write(",".join(list(params) + list(stats)) + ',' + tree + "\n")
+		for row in rows:
+			self.out.write(row + "\n")
+
+	def close(self):
+		self.out.flush()
+
+
+class binary_sink:
+	def __init__(self, shard_path, num_seqs):
+		self.writer = sample_shards.shard_writer(shard_path, num_seqs)
+
+	def write(self, params, stats, tree, rows):
+		self.writer.write(params, stats, tree, rows)
+
+	def close(self):
+		self.writer.close()
+
+
+def submodel_params_from_settings(settings):
+	submodel_params = dict(SUBMODEL_PARAMS[settings.mode])
+	if settings.substitution_simulator == "native":
+		submodel_params["simulator"] = "native"
+	return submodel_params
+
+
+def generate_samples(settings, start, end):
+	"""
+	yields the samples [start, end) as (params, stats, tree, rows).
+	The samples only depend on settings.seed and start, not on the worker or the sink.
+	"""
+	seed = pgen.task_seed(settings.seed, start)
+	random.seed(seed)
+	# independent streams for the trees and the simulations, so parameters do not follow branch lengths
+	tree_seed, simulation_seed = np.random.SeedSequence(seed).spawn(2)
+	rng = np.random.default_rng(simulation_seed)
+	submodel_params = submodel_params_from_settings(settings)
+	trees = tree_sampler.sample_trees(end - start, settings.num_taxa, settings.min_branch_length,
+									  settings.max_branch_length, seed=tree_seed)
+	seq_lengths = [random.randint(settings.min_seq_length, settings.max_seq_length) for _ in range(start, end)]
+
+	with tool_runner.scratch_dir('generate_') as scratch_path:
+		indel_backend = INDEL_BACKENDS[settings.indel_simulator](settings, scratch_path)
+		for batch_start in range(0, end - start, settings.batch_size):
+			batch = range(batch_start, min(batch_start + settings.batch_size, end - start))
+			samples = [indel_backend.simulate(trees[i], seq_lengths[i], rng) for i in batch]
+			msas = [msa for _, _, msa in samples]
+			if any(stats is None for _, stats, _ in samples):
+				batch_stats = sstats.summary_stats_batch([sstats.fasta_to_rows(msa) for msa in msas])
+				samples = [(params, sstats.format_stats(batch_stats[j]) if stats is None else stats, msa)
+						   for j, (params, stats, msa) in enumerate(samples)]
+			msa_widths = [len(corrector.process_raw_msa(msa)[0][0]) for msa in msas]
+			substitution_msas = corrector.simulate_substitutions_batch(scratch_path, [trees[i] for i in batch],
+																	   msa_widths, submodel_params, seed=rng)
+			_, sub_sim_msas = corrector.add_subs_to_sim_msa_batch(msas, substitution_msas)
+			for i, (params, stats, _), sub_sim_msa in zip(batch, samples, sub_sim_msas):
+				yield params, stats, trees[i], corrector.process_raw_msa(sub_sim_msa)[0]
+			logger.info(f'generated samples {start + batch.start}-{start + batch.stop}')
+
+
+def shard_suffix(settings):
+	return sample_shards.SHARD_SUFFIX if settings.sink == "binary" else ''
+
+
+def write_samples(sink, samples):
+	for sample in samples:
+		sink.write(*sample)
+	sink.close()
+
+
+def generate_range(settings, start, end):
+	"""
+	writes the samples [start, end) to their shard in settings.data_set_path.
+	"""
+	suffix = shard_suffix(settings)
+	tmp_path = pgen.tmp_shard_path(settings.data_set_path, start, end, suffix)
+	samples = generate_samples(settings, start, end)
+	if settings.sink == "binary":
+		write_samples(binary_sink(tmp_path, settings.num_taxa), samples)
+	else:
+		with open(tmp_path, 'w') as f:
+			write_samples(text_sink(f), samples)
+	pgen.commit_shard(settings.data_set_path, start, end, suffix)
+
+
+def manifest_settings(settings):
+	"""
+	the arguments the samples depend on, a data set is only resumed with the same ones.
+	"""
+	return {key: value for key, value in vars(settings).items() if key not in ('data_set_path', 'num_workers')}
+
+
+def generate(settings):
+	if settings.sink == "stdout":
+		write_samples(text_sink(sys.stdout), generate_samples(settings, 0, settings.num_samples))
+		return
+
+	if not os.path.isdir(settings.data_set_path):
+		os.makedirs(settings.data_set_path)
+	manifest = pgen.load_manifest(settings.data_set_path, settings.num_samples,
+								  settings.num_workers, settings.num_samples_per_file, manifest_settings(settings))
+	for task, _ in pgen.run_tasks(functools.partial(generate_range, settings),
+								  pgen.pending_tasks(manifest), settings.num_workers):
+		pgen.record_completed(settings.data_set_path, manifest, task)
+	if settings.sink == "text":
+		pgen.merge_shards(settings.data_set_path, manifest)
+	else:
+		logger.info('binary shards are kept per sample range')
+
+
+def get_parser():
+	parser = argparse.ArgumentParser(description='Generates simulated alignments with their indel parameters and summary statistics.')
+	parser.add_argument('data_set_path', nargs='?', default='.', help='output directory (ignored by the stdout sink)')
+	parser.add_argument('--num-taxa', type=int, default=10)
+	parser.add_argument('--mode', choices=sorted(SUBMODEL_PARAMS), default='nuc')
+	parser.add_argument('--model-type', choices=['dif', 'eq'], default='dif')
+	parser.add_argument('--num-samples', type=int, default=1000)
+	parser.add_argument('--num-samples-per-file', type=int, default=NUM_OF_SAMPLES_PER_FILE)
+	parser.add_argument('--min-seq-length', type=int, default=32)
+	parser.add_argument('--max-seq-length', type=int, default=44)
+	parser.add_argument('--min-branch-length', type=float, default=0.02)
+	parser.add_argument('--max-branch-length', type=float, default=0.1)
+	parser.add_argument('--min-ir', type=float, default=0.0)
+	parser.add_argument('--max-ir', type=float, default=0.05)
+	parser.add_argument('--min-a', type=float, default=1.001)
+	parser.add_argument('--max-a', type=float, default=2.0)
+	parser.add_argument('--sink', choices=['text', 'binary', 'stdout'], default='text')
+	parser.add_argument('--indel-simulator', choices=sorted(INDEL_BACKENDS), default='sparta')
+	parser.add_argument('--substitution-simulator', choices=['indelible', 'native'], default='indelible')
+	parser.add_argument('--sparta-exec', default=DEFAULT_SPARTA_EXEC)
+	parser.add_argument('--batch-size', type=int, default=1000, help='samples per substitution simulator call')
+	parser.add_argument('--num-workers', type=int, default=1)
+	parser.add_argument('--seed', type=int, default=0)
+	return parser
+
+
+def main(argv=None):
+	settings = get_parser().parse_args(argv)
+	generate(settings)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+	main()
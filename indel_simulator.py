@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+In-process simulator of the SpartaABC SIM ('eq') and RIM ('dif') indel models.
+
+Indel lengths follow a Zipf distribution truncated at MAX_INDEL_SIZE,
+insertions and deletions occur at per-site rates IR and DR along every branch
+of the tree. Parameters are drawn from the same uniform priors SpartaABC uses
+(see configuration.get_sparta_config), so one call replaces a SpartaABC run
+with _numSimulations == _alignments_output.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+from ete3 import Tree
+
+from configuration import PARAMS_COLS
+
+
+MAX_INDEL_SIZE = 50
+# SpartaABC derives the root length prior from the input MSA sequence lengths.
+RL_PRIOR_FACTORS = (0.8, 1.1)
+
+
+def rl_prior_from_msa(msa):
+	"""
+	returns the (min, max) root length prior SpartaABC uses for the given list of sequences.
+	"""
+	seq_lengths = [len(seq.replace('-', '')) for seq in msa]
+	return int(RL_PRIOR_FACTORS[0]*min(seq_lengths)), int(RL_PRIOR_FACTORS[1]*max(seq_lengths))
+
+
+def sample_params(num_alignments, model_type, min_rl, max_rl,
+				  min_ir=0, max_ir=0.05, min_a=1.001, max_a=2.0, rng=None):
+	"""
+	draws indel parameters from the SpartaABC priors.
+	In the 'eq' model insertion and deletion share their rate and Zipf parameter.
+	"""
+	rng = np.random.default_rng(rng)
+	params = pd.DataFrame({
+		'RL': rng.integers(int(min_rl), int(max_rl) + 1, size=num_alignments),
+		'AIR': rng.uniform(min_a, max_a, size=num_alignments),
+		'ADR': rng.uniform(min_a, max_a, size=num_alignments),
+		'IR': rng.uniform(min_ir, max_ir, size=num_alignments),
+		'DR': rng.uniform(min_ir, max_ir, size=num_alignments),
+	}, columns=PARAMS_COLS)
+	if model_type == 'eq':
+		params['ADR'] = params['AIR']
+		params['DR'] = params['IR']
+	return params
+
+
+def zipf_cdf(a, max_size=MAX_INDEL_SIZE):
+	"""
+	cumulative distribution of indel lengths 1..max_size for Zipf parameters a (vectorized over a).
+	"""
+	a = np.atleast_1d(np.asarray(a, dtype=float))
+	pmf = np.arange(1, max_size + 1, dtype=float)[np.newaxis, :] ** -a[:, np.newaxis]
+	cdf = np.cumsum(pmf, axis=1)
+	return cdf / cdf[:, -1:]
+
+
+def load_tree(tree):
+	if isinstance(tree, Tree):
+		return tree
+	return Tree(tree, format=1)
+
+
+def flatten_tree(tree):
+	"""
+	returns the tree in preorder as (parent index, branch length) arrays and the leaf indices and names.
+	"""
+	nodes = list(tree.traverse('preorder'))
+	index = {node: i for i, node in enumerate(nodes)}
+	parents = np.array([index[node.up] if node.up is not None else -1 for node in nodes])
+	lengths = np.array([node.dist if node.up is not None else 0.0 for node in nodes])
+	leaves = [i for i, node in enumerate(nodes) if node.is_leaf()]
+	names = [nodes[i].name for i in leaves]
+	return parents, lengths, leaves, names
+
+
+class _column_registry:
+	"""
+	keeps, for every simulated column, the column it was inserted after and the event that created it.
+	Sorting children by decreasing event number and walking the resulting tree gives the true alignment order.
+	"""
+	def __init__(self):
+		self.anchors = []
+		self.events = []
+		self.event = 0
+
+	def new_block(self, anchor, size):
+		first = len(self.anchors)
+		self.anchors.append(anchor)
+		self.anchors.extend(range(first, first + size - 1))
+		self.events.extend([self.event]*size)
+		self.event += 1
+		return np.arange(first, first + size)
+
+	def order(self):
+		anchors = np.array(self.anchors)
+		events = np.array(self.events)
+		by_anchor = np.lexsort((-events, anchors))
+		children = {}
+		for col in by_anchor:
+			children.setdefault(anchors[col], []).append(col)
+		order = []
+		stack = list(reversed(children.get(-1, [])))
+		while stack:
+			col = stack.pop()
+			order.append(col)
+			stack.extend(reversed(children.get(col, [])))
+		return np.array(order, dtype=np.int64)
+
+
+def _simulate_branch(seq, length, ir, dr, ins_cdf, del_cdf, registry, rng):
+	time_left = length
+	while True:
+		seq_len = len(seq)
+		ins_rate = ir*(seq_len + 1)
+		del_rate = dr*seq_len
+		total_rate = ins_rate + del_rate
+		if total_rate <= 0:
+			return seq
+		time_left -= rng.exponential(1/total_rate)
+		if time_left < 0:
+			return seq
+		is_insertion = rng.random()*total_rate < ins_rate
+		size = int(np.searchsorted(ins_cdf if is_insertion else del_cdf, rng.random(), side='right')) + 1
+		if is_insertion:
+			pos = rng.integers(0, seq_len + 1)
+			anchor = seq[pos - 1] if pos > 0 else -1
+			seq = np.concatenate((seq[:pos], registry.new_block(anchor, size), seq[pos:]))
+		else:
+			pos = rng.integers(0, seq_len)
+			seq = np.concatenate((seq[:pos], seq[pos + size:]))
+
+
+def simulate_alignment(tree, rl, ir, dr, air, adr, rng=None):
+	"""
+	simulates one true alignment along the tree.
+	Returns a (num_leaves, msa_len) boolean matrix (True = residue) and the leaf names.
+	"""
+	rng = np.random.default_rng(rng)
+	parents, lengths, leaves, names = flatten_tree(load_tree(tree))
+	ins_cdf, del_cdf = zipf_cdf([air, adr])
+	return _simulate_flat(parents, lengths, leaves, int(rl), ir, dr, ins_cdf, del_cdf, rng), names
+
+
+def _simulate_flat(parents, lengths, leaves, rl, ir, dr, ins_cdf, del_cdf, rng):
+	registry = _column_registry()
+	seqs = [None]*len(parents)
+	seqs[0] = registry.new_block(-1, rl) if rl > 0 else np.array([], dtype=np.int64)
+	for node in range(1, len(parents)):
+		seqs[node] = _simulate_branch(seqs[parents[node]], lengths[node], ir, dr,
+									  ins_cdf, del_cdf, registry, rng)
+
+	order = registry.order()
+	rank = np.empty(len(order), dtype=np.int64)
+	rank[order] = np.arange(len(order))
+	present = np.zeros((len(leaves), len(order)), dtype=bool)
+	for row, leaf in enumerate(leaves):
+		present[row, rank[seqs[leaf]]] = True
+	return present[:, present.any(axis=0)]
+
+
+def alignment_to_fasta(present, names, residue='A'):
+	rows = np.where(present, ord(residue), ord('-')).astype(np.uint8)
+	return "".join(f'>{name}\n{row.tobytes().decode()}\n' for name, row in zip(names, rows))
+
+
+def simulate_alignments(tree, num_alignments, model_type='dif', min_rl=50, max_rl=500,
+						min_ir=0, max_ir=0.05, min_a=1.001, max_a=2.0, seed=None):
+	"""
+	simulates num_alignments true alignments along the same tree, each with its own parameters
+	drawn from the priors.
+	Returns the alignments as fasta strings (SpartaABC alignments file layout) and a
+	DataFrame of the parameters with the posterior_params column names.
+	"""
+	rng = np.random.default_rng(seed)
+	parents, lengths, leaves, names = flatten_tree(load_tree(tree))
+	params = sample_params(num_alignments, model_type, min_rl, max_rl,
+						   min_ir, max_ir, min_a, max_a, rng)
+	ins_cdfs = zipf_cdf(params['AIR'].values)
+	del_cdfs = zipf_cdf(params['ADR'].values)
+
+	alignments = []
+	for i, (rl, ir, dr) in enumerate(params[['RL', 'IR', 'DR']].itertuples(index=False)):
+		present = _simulate_flat(parents, lengths, leaves, int(rl), ir, dr,
+								 ins_cdfs[i], del_cdfs[i], rng)
+		alignments.append(alignment_to_fasta(present, names))
+	logger.info(f'simulated {num_alignments} alignments with the {model_type} model')
+	return alignments, params
+
+
+def write_alignments_file(alignments_path, alignments):
+	"""
+	writes alignments in the layout of SpartaABC _outputAlignmnetsFile
+	(read by msa_bias_corrector.parse_alignments_file).
+	"""
+	with open(alignments_path, 'w') as f:
+		for alignment in alignments:
+			f.write(alignment)
+			f.write("\n")
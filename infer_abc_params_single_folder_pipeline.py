@@ -19,6 +19,8 @@ import matplotlib.pyplot as plt
 from sklearn.utils.multiclass import unique_labels
 import random
 
+import posterior_params
+
 
 
 ### Load lib data
@@ -31,16 +33,11 @@ def load_lib_data(path,lib='data_name',models_list=['ideq','iddif'] ,size_th=1E6
 		if os.stat(file_name).st_size<size_th:
 			logging.warning(f'{file_name} too small.')
 			return None,None
-		with open(file_name) as f:
-			file_rows_num = sum(1 for line in f)
-		df_tmp = pd.read_csv(file_name, delimiter='\t',
-							 skiprows=[i for i in range(1,4)],nrows=(file_rows_num-11))
-		weights = pd.read_csv(file_name, delimiter='\t').iloc[[1]]
-		num_dropped = 0
-		for col in weights.columns:
-			if weights.iloc[0][col] == 0:
-				num_dropped += 1
-				df_tmp.drop(col, axis=1, inplace=True)
+		weights = posterior_params.read_meta(file_name).iloc[[1]]
+		used_cols = [col for col in weights.columns if not weights.iloc[0][col] == 0]
+		# read from the binary sidecar of the file when it has one
+		_, df_meta, df_tmp, _ = posterior_params.read_posterior_params(file_name, usecols=used_cols)
+		num_dropped = len(weights.columns) - len(used_cols)
 		logger.info(f'dropped {num_dropped} features from {models_list[i]} model')
 
 		df_tmp['model_id'] = i
@@ -52,9 +49,6 @@ def load_lib_data(path,lib='data_name',models_list=['ideq','iddif'] ,size_th=1E6
 			df_tmp = df_tmp.iloc[n_drop:]
 			df = pd.concat((df,df_tmp),join='inner')
 
-		df_meta = pd.read_csv(file_name, delimiter='\t',
-							  nrows=2)
-
 	df = df.reset_index(drop=True)
 	df_meta = df_meta[list(df.columns)[:-2]]
 
@@ -5,18 +5,24 @@ Created on Sun Feb 28 13:19:36 2021
 @author: gillo
 """
 #imports
-import subprocess
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import logging
 logger = logging.getLogger(__name__)
 import re
 import pandas as pd
 import numpy as np
-from sklearn import linear_model 
-from sklearn import model_selection
 from scipy.stats import pearsonr
 
-from  configuration import get_sparta_config, get_indelible_config
+from  configuration import get_sparta_config, get_indelible_config, SUMMARY_STATS_COLS, PARAMS_COLS
+import substitution_simulator as subsim
+import summary_statistics as sstats
+import result_cache
+import realignment_store
+import posterior_params
+import correction_models
+import realigners
+import tool_runner
 
 
 
@@ -36,24 +42,10 @@ def parse_alignments_file(real_alignments_path):
 	max_sim_seq_len = len(max(lines.split('\n'),key=len))
 	return align_list, max_sim_seq_len
 
-def prepare_indelible_control_file(res_path,tree_filename,indelible_out_file_name,
-								   num_msa,max_sim_seq_len,pipeline_path,
-								   indelible_template_file_name,
-								   submodel_params):
+def set_indelible_submodel(indelible_config, submodel_params):
 	"""
-	prepare indelible control file for simulating substitutions
+	fills the substitution model entries of an indelible config according to submodel_params
 	"""
-	indelible_config = get_indelible_config()
-
-
-	with open(res_path+tree_filename,'r') as f:
-		tree = f.read().rstrip()
-
-	indelible_config["[TREE]"] = f'treename {tree}'
-	indelible_config["[PARTITIONS]"] = f'partitionname\n[treename modelname {max_sim_seq_len}]'
-	# note: do not change 'outputname1'
-	indelible_config["[EVOLVE]"] = f'partitionname {num_msa} outputname1' + " " # note: indlible requires space at last command.
-
 	if submodel_params["mode"] == "amino":
 		indelible_config["[TYPE]"] = 'AMINOACID 2'
 		indelible_config["[submodel]"] = 'WAG'
@@ -77,41 +69,121 @@ def prepare_indelible_control_file(res_path,tree_filename,indelible_out_file_nam
 			
 			del indelible_config['[statefreq]']
 			del indelible_config['[rates]']
+	return indelible_config
+
+def indelible_config_text(indelible_config):
+	return "".join(f'{key} {indelible_config[key]}\n' for key in indelible_config)
+
+def indelible_control_text(tree, num_msa, max_sim_seq_len, submodel_params, seed=None):
+	"""
+	indelible control file content simulating num_msa substitution msas along the tree into 'outputname1'.
+	With a seed, indelible draws the same msas on every run.
+	"""
+	indelible_config = get_indelible_config()
+
+	indelible_config["[TREE]"] = f'treename {tree}'
+	indelible_config["[PARTITIONS]"] = f'partitionname\n[treename modelname {max_sim_seq_len}]'
+	# note: do not change 'outputname1'
+	indelible_config["[EVOLVE]"] = f'partitionname {num_msa} outputname1' + " " # note: indlible requires space at last command.
+
+	set_indelible_submodel(indelible_config, submodel_params)
+	if seed is not None:
+		# [SETTINGS] goes right after [TYPE]
+		indelible_config["[SETTINGS]"] = f'\n[randomseed] {seed}'
+		for key in [key for key in indelible_config if key not in ("[TYPE]", "[SETTINGS]")]:
+			indelible_config.move_to_end(key)
+	return indelible_config_text(indelible_config)
+
+def prepare_indelible_control_file(res_path,tree_filename,indelible_out_file_name,
+								   num_msa,max_sim_seq_len,pipeline_path,
+								   indelible_template_file_name,
+								   submodel_params):
+	"""
+	prepare indelible control file for simulating substitutions
+	"""
+	with open(res_path+tree_filename,'r') as f:
+		tree = f.read().rstrip()
 
 	with open(res_path+indelible_out_file_name,'w') as fout:
-		for key in indelible_config:
-			to_write = f'{key} {indelible_config[key]}\n'
-			fout.write(to_write)
+		fout.write(indelible_control_text(tree, num_msa, max_sim_seq_len, submodel_params))
 
+def indelible_batch_control_text(trees, seq_lengths, submodel_params, num_msa=1):
+	"""
+	indelible control file content simulating substitutions for many trees.
+	Tree i gets its own partition of length seq_lengths[i], evolved num_msa times into 'batch_output{i}'.
+	Returns the content and the output names in the order of the trees.
+	"""
+	indelible_config = set_indelible_submodel(get_indelible_config(), submodel_params)
+	output_names = [f'batch_output{i}' for i in range(len(trees))]
+
+	indelible_config["[TREE]"] = "\n[TREE] ".join(f'tree{i} {tree.rstrip()}' for i, tree in enumerate(trees))
+	indelible_config["[PARTITIONS]"] = "\n[PARTITIONS] ".join(f'partition{i} [tree{i} modelname {seq_len}]'
+															  for i, seq_len in enumerate(seq_lengths))
+	indelible_config["[EVOLVE]"] = "\n".join(f'partition{i} {num_msa} {name}'
+											  for i, name in enumerate(output_names)) + " " # note: indlible requires space at last command.
+	return indelible_config_text(indelible_config), output_names
+
+def prepare_indelible_batch_control_file(res_path, trees, seq_lengths, submodel_params,
+										 indelible_out_file_name='control.txt', num_msa=1):
+	"""
+	prepare a single indelible control file simulating substitutions for many trees.
+	Returns the output names in the order of the trees.
+	"""
+	control_text, output_names = indelible_batch_control_text(trees, seq_lengths, submodel_params, num_msa)
+	with open(res_path+indelible_out_file_name,'w') as fout:
+		fout.write(control_text)
+	return output_names
+
+
+def run_indelible(res_path,logger=None,control_text=None):
+	"""
+	runs indelible in a scratch directory.
+	Runs control_text, or control.txt at res_path when it is not given.
+	"""
+	if control_text is None:
+		with open(f'{res_path}control.txt','r') as f:
+			control_text = f.read()
+	if logger!=None:
+		logger.info(f'Starting indelible.')
+	indelible_output, = tool_runner.run_indelible(control_text, ['outputname1'])
+	return split_indelible_output(indelible_output)
 
-def run_indelible(res_path,logger=None):
+def run_indelible_batch(control_text, output_names, logger=None):
 	"""
-	runs indelible.
-	Requires control.txt at res_path and indelible command
+	runs indelible once on a batch control text (see indelible_batch_control_text).
+	Returns, for every output name, the list of msas simulated for it.
 	"""
-	os.chdir(res_path)
-	cmd = "indelible"
 	if logger!=None:
-		logger.info(f'Starting indelible. Executed command is:\n{cmd}')
-	subprocess.run(cmd, shell=True)
-	indelible_msa_list = parse_indelible_output(res_path)
-	# clean indelible files
-	os.remove(f'{res_path}outputname1_TRUE.phy')
-	os.remove(f'{res_path}outputname1.fas')
-	os.remove(f'{res_path}trees.txt')
-	os.remove(f'{res_path}LOG.txt')
+		logger.info(f'Starting indelible on a batch of {len(output_names)} partitions.')
+	indelible_outputs = tool_runner.run_indelible(control_text, output_names)
+	return [split_indelible_output(indelible_output) for indelible_output in indelible_outputs]
 
-	return indelible_msa_list
+def simulate_substitutions_batch(res_path, trees, seq_lengths, submodel_params, logger=None, seed=None):
+	"""
+	simulates one substitution msa per (tree, length) pair with a single indelible process.
+	Returns the msas in the order of the trees. seed is only used by the native simulator.
+	"""
+	if submodel_params.get("simulator") == "native":
+		return subsim.simulate_substitutions_batch(trees, seq_lengths, submodel_params, seed)
+	control_text, output_names = indelible_batch_control_text(trees, seq_lengths, submodel_params)
+	indelible_msa_lists = run_indelible_batch(control_text, output_names, logger)
+	return [msa_list[0] for msa_list in indelible_msa_lists]
 
-def parse_indelible_output(res_path):
+def split_indelible_output(indelible_subs):
 	"""
-	reads the output of indelible and parse it to list of msas
+	splits the fasta output of indelible to list of msas
 	"""
-	with open(res_path+'outputname1.fas','r') as f:
-		indelible_subs = f.read()
 	indelible_msa_list = re.split('\n *\n', indelible_subs)
 	return indelible_msa_list[:-1]
 
+def parse_indelible_output(res_path, output_name='outputname1'):
+	"""
+	reads the output of indelible and parse it to list of msas
+	"""
+	with open(f'{res_path}{output_name}.fas','r') as f:
+		indelible_subs = f.read()
+	return split_indelible_output(indelible_subs)
+
 def prepare_sparta_conf_sumstat(res_path, pipeline_path, sum_stat_file_name='tmp_sum_stat.csv',msa_filename='realigned_msa_tmp.fasta',conf_filename_out='sum_stat.conf',conf_file_template='sparta_conf_template.conf'):
 	"""
 	prepare a configuration file for running sparta so that it only calculate the summary statistics
@@ -142,126 +214,175 @@ def restructure_msa(msa_list, organism_list):
 
 	return "\n".join(new_msa)
 
+GAP = ord('-')
+
+def rows_to_array(rows, width):
+	"""
+	stacks msa rows into a (num_rows, width) uint8 array, padding with gaps
+	"""
+	if all(len(row) == width for row in rows):
+		return np.frombuffer("".join(rows).encode(), dtype=np.uint8).reshape(len(rows), width)
+	array = np.full((len(rows), width), GAP, dtype=np.uint8)
+	for i, row in enumerate(rows):
+		row = np.frombuffer(row.encode(), dtype=np.uint8)[:width]
+		array[i, :len(row)] = row
+	return array
+
+def add_subs_to_sim_msa_batch(raw_sim_msas, indelible_msas):
+	"""
+	add AA from indelible output to every simulated alignment of the batch
+	in all non-gapped locations. The batch is stacked in a (msa, seq, column)
+	array and merged with a single masked assignment.
+	Returns the lists of unaligned and aligned fasta strings.
+	"""
+	sim_msas = [process_raw_msa(raw_sim_msa) for raw_sim_msa in raw_sim_msas]
+	indelible_msa_lists = [process_raw_msa(indelible_msa)[0] for indelible_msa in indelible_msas]
+
+	num_seqs = max(len(sim_msa_list) for sim_msa_list, _ in sim_msas)
+	msa_lens = [len(sim_msa_list[0]) for sim_msa_list, _ in sim_msas]
+	width = max(msa_lens)
+
+	merged = np.full((len(sim_msas), num_seqs, width), GAP, dtype=np.uint8)
+	subs = np.full((len(sim_msas), num_seqs, width), GAP, dtype=np.uint8)
+	for i, ((sim_msa_list, _), indelible_msa_list) in enumerate(zip(sim_msas, indelible_msa_lists)):
+		merged[i, :len(sim_msa_list)] = rows_to_array(sim_msa_list, width)
+		subs[i, :len(indelible_msa_list)] = rows_to_array(indelible_msa_list, width)[:num_seqs]
+	non_gaps = merged != GAP
+	merged[non_gaps] = subs[non_gaps]
+
+	unaligned_sub_sim_msas = []
+	sub_sim_msas = []
+	for i, (sim_msa_list, organism_list) in enumerate(sim_msas):
+		rows = merged[i, :len(sim_msa_list), :msa_lens[i]]
+		sub_sim_msa_list = [row.tobytes().decode() for row in rows]
+		unaligned_sub_sim_msa_list = [row[row != GAP].tobytes().decode() for row in rows]
+		sub_sim_msas.append(restructure_msa(sub_sim_msa_list, organism_list))
+		unaligned_sub_sim_msas.append(restructure_msa(unaligned_sub_sim_msa_list, organism_list))
+	return unaligned_sub_sim_msas, sub_sim_msas
+
 def add_subs_to_sim_msa(raw_sim_msa,indelible_msa):
 	"""
 	add AA from indelible output file to the simulated alignment
 	in all non-gapped locations
 	"""
-	sim_msa_list, organism_list = process_raw_msa(raw_sim_msa)
-	indelible_msa_list = process_raw_msa(indelible_msa)[0]
-
-	sub_sim_msa_list = []
-	unaligned_sub_sim_msa_list = []
-	for i,alignment in enumerate(sim_msa_list):
-		merged_alignment = ""
-		for j,c in enumerate(alignment):
-			if c=='-':
-				merged_alignment += "-"
-			else:
-				merged_alignment += indelible_msa_list[i][j]
-		sub_sim_msa_list.append(merged_alignment)
-		unaligned_sub_sim_msa_list.append(merged_alignment.replace('-',''))
-	
-	sub_sim_msa_list = restructure_msa(sub_sim_msa_list, organism_list)
+	unaligned_sub_sim_msas, sub_sim_msas = add_subs_to_sim_msa_batch([raw_sim_msa], [indelible_msa])
+	return unaligned_sub_sim_msas[0], sub_sim_msas[0]
 
-	unaligned_sub_sim_msa = restructure_msa(unaligned_sub_sim_msa_list, organism_list)
-	return unaligned_sub_sim_msa, sub_sim_msa_list
-
-def restructure_mafft_output(mafft_output):
-	restructured_output = ""
-	restructured_temp = mafft_output.split(">")[1:]
-	for item in restructured_temp:
-		organism, sequence = item.split("\n", 1)
-		sequence = sequence.replace("\n",'')
-		restructured_output += f">{organism}\n{sequence}\n"
-
-	return restructured_output
-
-def reconstruct_msa(res_path, unaligned_msa, output_name,  align_mode,logger=None):
-
-	tmp_file = "temp_unaligned.fasta"
-	
-	with open(f'{res_path}{tmp_file}', 'w') as f:
-		f.write(unaligned_msa)
+def reconstruct_msa(res_path, unaligned_msa, output_name,  align_mode,logger=None,realigner_name='mafft'):
+	"""
+	realigns the unaligned msa with the realigner backend (see realigners), MAFFT by default.
+	Realignments are cached by input and aligner version (see result_cache).
+	"""
+	realigner = realigners.get_realigner(realigner_name)
+	if logger!=None:
+		logger.info(f'Starting {realigner_name} in {align_mode} mode.')
+	version = f"{realigner.version()} --{align_mode}"
+	return result_cache.cached(realigner_name, version, unaligned_msa,
+							   compute=lambda: realigner.align(unaligned_msa, align_mode),
+							   encode=str.encode, decode=bytes.decode)
 
-	cmd = f'mafft --auto --{align_mode} {res_path+tmp_file}'
-	
+def iter_reconstruct_msas(res_path, unaligned_msas, align_mode, num_workers=None, logger=None, realigner_name='mafft'):
+	"""
+	realigns many msas concurrently, num_workers (default: number of cores) at a time.
+	Every aligner process runs in its own scratch directory. Yields (index, realignment) as they finish.
+	"""
+	num_workers = num_workers or os.cpu_count()
 	if logger!=None:
-		logger.info(f'Starting MAFFT. Executed command is:\n{cmd}')
-	results = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
-	
-	results = restructure_mafft_output(results)
-	# TODO: remove file safely
-	os.remove(res_path+tmp_file)
-	return results
-	
-def run_sparta_sum_stat(input_msa, pipeline_path, conf_file_path):
-	with open(conf_file_path, 'r') as f:
-		msa_path = next(filter(lambda x: "_inputRealMSAFile" in x, f.readlines()))
-	msa_path = msa_path.split(" ")[1].rstrip("\n")
-	with open(msa_path,'w') as f:
-		f.write(input_msa)
-	#TODO in linux - remove exe
-	cmd = f'{pipeline_path}SpartaABC {conf_file_path}'
-	subprocess.run(cmd, shell=True)
-	os.remove(msa_path)
+		logger.info(f'Realigning {len(unaligned_msas)} msas with {num_workers} {realigner_name} workers.')
+	# threads are enough for external aligners, the work happens in their processes, but
+	# in-process aligners hold the GIL and need worker processes
+	in_process = realigners.get_realigner(realigner_name).in_process
+	executor_class = ProcessPoolExecutor if in_process and num_workers > 1 else ThreadPoolExecutor
+	with executor_class(max_workers=num_workers) as executor:
+		futures = {executor.submit(reconstruct_msa, res_path, unaligned_msa, None, align_mode,
+								   realigner_name=realigner_name): i
+				   for i, unaligned_msa in enumerate(unaligned_msas)}
+		for future in as_completed(futures):
+			yield futures[future], future.result()
+
+def reconstruct_msas(res_path, unaligned_msas, align_mode, num_workers=None, logger=None, realigner_name='mafft'):
+	"""
+	realigns many msas concurrently (see iter_reconstruct_msas). Returns the realignments in input order.
+	"""
+	realigned_msas = [None]*len(unaligned_msas)
+	for i, realigned_msa in iter_reconstruct_msas(res_path, unaligned_msas, align_mode, num_workers,
+												  logger, realigner_name):
+		realigned_msas[i] = realigned_msa
+	return realigned_msas
 	
-def load_sim_res_file(sim_res_file_path):
+def sum_stat_table(stats):
+	"""
+	table of summary statistics (one row per msa) laid out like the SpartaABC stats file.
+	"""
+	df_sum_stat = pd.DataFrame(stats, columns=SUMMARY_STATS_COLS)
+	for col in reversed(['DISTANCE'] + PARAMS_COLS):
+		df_sum_stat.insert(0, col, np.nan)
+	df_sum_stat['DISTANCE'] = 'input_msa'
+	return df_sum_stat
 
-	with open(sim_res_file_path) as f:
-	  file_rows_num = sum(1 for line in f)
-	df_real = pd.read_csv(sim_res_file_path, delimiter='\t',skiprows=[i for i in range(1,4)],nrows=(file_rows_num-11))
-	df_meta = pd.read_csv(sim_res_file_path, delimiter='\t', nrows=2)
-	return df_real, df_meta   
-	
-def lasso_reg(X,y):
-	# X,y? should be normalized
-	reg = linear_model.Lasso(normalize=False,fit_intercept=True)
-	parameters = {'alpha':np.logspace(-7,4,20)}
-	clf = model_selection.GridSearchCV(estimator = reg,
-							   param_grid = parameters, cv=3,
-							   scoring = 'neg_mean_squared_error')
-	clf.fit(X,y)
-	cv_rmse = np.min(np.sqrt(-clf.cv_results_['mean_test_score']))
-	
-	res = clf.predict(X)
-	out_stat = (pearsonr(res,y),cv_rmse)
-	return clf,out_stat
+def run_sparta_sum_stat(input_msa, pipeline_path, conf_file_path=None):
+	"""
+	summary statistics of the msa as a one row table, laid out like the SpartaABC stats file.
+	Computed in-process by summary_statistics, conf_file_path is no longer used.
+	"""
+	return sum_stat_table([sstats.summary_stats(sstats.fasta_to_rows(input_msa))])
 	
-def correct_mafft_bias(res_path, sim_res_file_path, df_mafft, num_msa,model_type, filter_p, alignment_flag):
+def load_sim_res_file(sim_res_file_path):
+	"""
+	simulations, input msa/weights rows and footer lines of a posterior_params file, parsed once
+	(see posterior_params.read_posterior_params). The simulations are memory-mapped from the sidecar
+	of the file, so slices of them are read on demand.
+	"""
+	_, df_meta, df_real, footer = posterior_params.read_posterior_params(sim_res_file_path)
+	return df_real, df_meta, footer
+
+# simulations predicted and written at a time by correct_mafft_bias
+CHUNK_ROWS = 20000
+# submodel_params that do not change realignments, left out of the realignment store meta
+NON_REALIGNMENT_PARAMS = ("realign_workers", "correction_model", "adaptive_realignment", "adaptive_increment",
+						  "adaptive_tolerance", "adaptive_min_msas", "adaptive_rmse_floor")
+# adaptive realignment (submodel_params['adaptive_realignment']): msas of the first fit, msas added
+# per refit, the change of cv rmse (relative) and Pearson quality under which fits are stable, and the
+# cv rmse under which relative changes are noise (submodel_params['adaptive_rmse_floor'])
+ADAPTIVE_MIN_MSAS = 50
+ADAPTIVE_INCREMENT = 25
+ADAPTIVE_TOLERANCE = 0.05
+ADAPTIVE_RMSE_FLOOR = 0.1
+
+def realignment_params(submodel_params):
+	"""
+	the submodel_params that change realignments, see NON_REALIGNMENT_PARAMS.
+	"""
+	return {key: value for key, value in submodel_params.items() if key not in NON_REALIGNMENT_PARAMS}
 
-	df_real, df_meta = load_sim_res_file(sim_res_file_path)
+def fit_bias_correction(df_sim, df_mafft, num_msa, filter_p, alignment_flag, correction_method='lasso'):
+	"""
+	fits the correction models on the first num_msa simulations of df_sim (see load_sim_res_file) and
+	selects the statistics used in distances (filter_p). Returns a correction_models.bias_correction.
+	"""
+	df_train = df_sim.iloc[:num_msa]
 	sstat_cols = list(df_mafft.columns)[6:]
 	params_cols = list(df_mafft.columns)[1:6]
 	train_cols =  params_cols+sstat_cols # sstat_cols
 	if alignment_flag:
-		X = df_real.iloc[int(num_msa/2):num_msa][train_cols].values
+		X = df_train.iloc[int(num_msa/2):num_msa][train_cols].values
 	else:
-		X = df_real.iloc[:num_msa][train_cols].values
-	X_full = df_real[train_cols].values
+		X = df_train.iloc[:num_msa][train_cols].values
 	Y = df_mafft[sstat_cols].values
 	X_train = X
 	X_train_mean = X_train.mean(axis=0)
 	X_train_std = X_train.std(axis=0) 
 	Y_train = Y
-	epsilon = 1E-4
-	X_train_reg = (X-X_train_mean+epsilon)/(X_train_std+epsilon)
-	X_full_reg = (X_full-X_train_mean+epsilon)/(X_train_std+epsilon)
-	X_full_reg[np.isnan(X_full_reg)] = 0
-	X_full_reg[X_full_reg == 10000000] = 0
+	X_train_reg = correction_models.standardize(X, X_train_mean, X_train_std)
 
-	
-	df_trans = df_real.copy()
-	for ind,p in enumerate(sstat_cols):
-		if alignment_flag:
-			y = Y_train[int(num_msa/2):num_msa,ind]
-		else:
-			y = Y_train[:,ind]
-		clf,out_stat = lasso_reg(X_train_reg,y)
-		df_trans[p] = clf.predict(X_full_reg)
-	
+	if alignment_flag:
+		Y_train = Y_train[int(num_msa/2):num_msa]
+	# all statistics are fitted together (see correction_models)
+	model = correction_models.fit_correction_model(X_train_reg, Y_train, method=correction_method)
+	logger.info(dict(zip(sstat_cols, model.cv_rmse)))
+	correction = correction_models.bias_correction(model, train_cols, sstat_cols, X_train_mean, X_train_std)
 
-	df_trans_subset = df_trans.iloc[:num_msa,:]
+	df_trans_subset = pd.DataFrame(correction.predict(df_train), columns=sstat_cols)
 	min_num_sumstat = filter_p[1]
 	correction_th = filter_p[0]
 
@@ -273,51 +394,76 @@ def correct_mafft_bias(res_path, sim_res_file_path, df_mafft, num_msa,model_type
 	logger.info(msa_correct_qual_dict)
 
 	sumstat_to_use = [x for x in msa_correct_qual_dict if msa_correct_qual_dict[x]>=correction_th]
-	with open(res_path + f"used_features_{model_type}.txt", 'w') as f:
-		f.write("\n".join(sumstat_to_use))
+	correction.used_features = sumstat_to_use
 
 
 	if len(sumstat_to_use) < min_num_sumstat:
 		sumstat_to_use = sorted(msa_correct_qual_dict,key=msa_correct_qual_dict.get,reverse=True)[:min_num_sumstat]
+	correction.sumstat_to_use = sumstat_to_use
+	return correction
 
-	sumstat_to_drop = [x for x in sstat_cols if x not in sumstat_to_use]
-	sstat_cols_inds = [i for i,x in enumerate(df_trans.columns) if x in sstat_cols]
-	sstat_cols_dict = dict(zip(sstat_cols,sstat_cols_inds))
+def apply_bias_correction(res_path, sim_res, correction, model_type, chunk_rows=CHUNK_ROWS):
+	"""
+	writes the corrected table of the simulations and returns the weights of the statistics.
+	sim_res is the (simulations, input msa/weights rows, footer) of load_sim_res_file. The table is
+	written chunk_rows simulations at a time, so memory does not grow with its size.
+	"""
+	df_sim, df_meta, footer = sim_res
+	num_rows = len(df_sim)
+	sstat_cols = correction.sstat_cols
+	sumstat_to_use = correction.sumstat_to_use
+	with open(res_path + f"used_features_{model_type}.txt", 'w') as f:
+		f.write("\n".join(correction.used_features))
 
+	sumstat_to_drop = [x for x in sstat_cols if x not in sumstat_to_use]
 
 	# Calculating new weights
 	n_weights = 10000
+	df_tail = df_sim.iloc[max(num_rows-n_weights, 0):]
 	# TODO: figure out why std_dev is 0 for some inputs
-	std_dev = df_trans.iloc[-n_weights:].std().apply(lambda x: x if x > 0.001 else 10**5) # hack
+	std_dev = pd.DataFrame(correction.predict(df_tail), columns=sstat_cols).std().apply(lambda x: x if x > 0.001 else 10**5) # hack
 
 	weights = 1/(std_dev) # check - should be 1/sigma. check in cpp if indeed this the way (or squared)
 	# Check - not sure if correct
 	for i in sumstat_to_drop:
 		weights.at[i] = 0
 
-
-	df_trans['DISTANCE'] = np.sum(((df_meta.iloc[0][sumstat_to_use].values.reshape(1,-1).T-df_trans[sumstat_to_use].values.T)*weights[sumstat_to_use].values.reshape(-1,1))**2,axis=0)**0.5
-	df_trans_string = df_trans.to_csv(index=False, header=False, sep='\t', float_format='%.6f')
-
-
-
-	df_meta2 = df_meta.copy()
-	df_meta2.loc[1,sstat_cols] = weights
-	df_meta2_string = df_meta2.to_csv(index=False, header=False, sep='\t', float_format='%.6f')
-
-	df_head_string = df_meta2.head(0).to_csv(index=False, header=True, sep='\t', float_format='%.6f')
-
-	with open(sim_res_file_path,'r') as f:
-		string_tmp = f.readlines()
-
-	out_str = df_head_string+"\n"+df_meta2_string+df_trans_string+"".join(string_tmp[-7:])
-	out_str = out_str.replace('\r','')
-	del string_tmp
+	used_weights = weights[sumstat_to_use].values
 	file_name_out = f'{res_path}SpartaABC_msa_corrected_id{model_type}.posterior_params'
-	with open(file_name_out,'w') as f:
-		f.write(out_str)
+	with open(file_name_out + '.tmp','w') as f:
+		df_meta2 = df_meta.copy()
+		df_meta2.loc[1,sstat_cols] = weights
+		df_meta2_string = df_meta2.to_csv(index=False, header=False, sep='\t', float_format='%.6f')
+
+		df_head_string = df_meta2.head(0).to_csv(index=False, header=True, sep='\t', float_format='%.6f')
+
+		real_sstats = df_meta.iloc[0][sumstat_to_use].values.astype(float)
+		f.write((df_head_string+"\n"+df_meta2_string).replace('\r',''))
+		for start in range(0, num_rows, chunk_rows):
+			df_trans = df_sim.iloc[start:start+chunk_rows].copy()
+			df_trans[sstat_cols] = correction.predict(df_trans)
+			distance = np.sqrt(np.sum(((real_sstats-df_trans[sumstat_to_use].values)*used_weights)**2,axis=1))
+			# written at full precision, as before the table was streamed
+			df_trans['DISTANCE'] = distance.astype(object)
+			f.write(df_trans.to_csv(index=False, header=False, sep='\t', float_format='%.6f').replace('\r',''))
+		f.write("".join(footer).replace('\r',''))
+	os.replace(file_name_out + '.tmp', file_name_out)
+	return weights[sstat_cols].values
 		
 
+def correct_mafft_bias(res_path, sim_res_file_path, df_mafft, num_msa,model_type, filter_p, alignment_flag, correction_method='lasso',
+					   chunk_rows=CHUNK_ROWS, store_key=None, sim_res=None):
+	"""
+	fits the correction models and writes the corrected table. The posterior_params file is parsed once,
+	or not at all when sim_res (see load_sim_res_file) is given. With store_key, the fitted correction
+	is saved to the correction model store for reuse on other datasets, unless the key is already stored.
+	"""
+	sim_res = load_sim_res_file(sim_res_file_path) if sim_res is None else sim_res
+	correction = fit_bias_correction(sim_res[0], df_mafft, num_msa, filter_p, alignment_flag, correction_method)
+	apply_bias_correction(res_path, sim_res, correction, model_type, chunk_rows)
+	if store_key is not None:
+		correction_models.save_correction(store_key, correction)
+	return correction
 
 def continuous_write(interation, file_path, to_write):
 	with open(file_path, ('w' if interation==0 else 'a')) as f:
@@ -327,7 +473,121 @@ def continuous_write(interation, file_path, to_write):
 
 def remove_large_files(res_path,to_remove):
 	for i in to_remove:
-		os.remove(f'{res_path}{i}')
+		if os.path.isfile(f'{res_path}{i}'):
+			os.remove(f'{res_path}{i}')
+		posterior_params.remove_sidecar(f'{res_path}{i}')
+
+def realign_msas(res_path, real_alignments_filename, tree_filename, align_list, max_sim_seq_len,
+				 model_type, submodel_params, num_msa=None):
+	"""
+	adds substitutions to the first num_msa (default: all) simulated alignments, realigns them and appends
+	the summary statistics of every realignment to the realignment store (see realignment_store) as it finishes.
+	Alignments already in the store (from an interrupted run) are not realigned again.
+	The substitutions of alignment i are seeded by the alignments file and i, so a resumed run rebuilds
+	the same realignment inputs and finds the realignments of the interrupted run in the result cache.
+	"""
+	num_msa = len(align_list) if num_msa is None else num_msa
+	realigner_name = submodel_params.get("realigner", "mafft")
+	with open(res_path+tree_filename,'r') as f:
+		tree = f.read().rstrip()
+	meta = {'alignments_sha256': realignment_store.file_sha256(res_path+real_alignments_filename),
+			'tree': tree,
+			'submodel_params': realignment_params(submodel_params),
+			'realigner': realigner_name,
+			'mode': submodel_params["mode"],
+			'stats_version': sstats.STATS_VERSION}
+	with realignment_store.realignment_store(res_path, model_type, meta) as store:
+		pending = store.pending(num_msa)
+		if len(store):
+			logger.info(f'{len(store)} MSAs of model {model_type} already realigned, {len(pending)} of the first {num_msa} to go')
+		if not pending:
+			return
+
+		seed = int(meta['alignments_sha256'][:7], 16)
+		if submodel_params.get("simulator") == "native":
+			indelible_msa_full_list = subsim.simulate_substitutions_indexed(tree, max_sim_seq_len, pending,
+																			submodel_params, seed)
+		else:
+			# indelible draws its replicates in order from the seed, so replicate i is the same on every run
+			control_text = indelible_control_text(tree, max(pending) + 1, max_sim_seq_len, submodel_params, seed)
+			indelible_msa_full_list = run_indelible(res_path, control_text=control_text)
+			indelible_msa_full_list = [indelible_msa_full_list[i] for i in pending]
+
+		logger.info(f'Number of indelible MSAs for model {model_type}: {len(indelible_msa_full_list)}')
+
+		# use indelible simul results to replace sparta alignment res.
+		unaligned_sub_sim_msas, indelible_sparta_msas = add_subs_to_sim_msa_batch([align_list[i] for i in pending],
+																				   indelible_msa_full_list[:len(pending)])
+		# run mafft on unaligned sequences, recording every realignment as it finishes.
+		num_written = len(store)
+		for j, realigned_msa in iter_reconstruct_msas(res_path, unaligned_sub_sim_msas, submodel_params["mode"],
+													  num_workers=submodel_params.get("realign_workers"), logger=logger,
+													  realigner_name=realigner_name):
+			# realignments are written in the order they finish, each after a ';alignment <index>' comment line
+			continuous_write(interation=num_written,
+							file_path=f'{res_path}{f"all_realigned_sims_{model_type}.txt"}',
+							to_write=f';alignment {pending[j]}\n{realigned_msa}')
+			num_written += 1
+			store.append(pending[j], sstats.summary_stats(sstats.fasta_to_rows(realigned_msa)))
+	logger.info(f'Done with MAFFT')
+
+def load_mafft_sum_stats(res_path, model_type, num_msa):
+	"""
+	summary statistics table of the realignments (see sum_stat_table), ordered like the simulated alignments.
+	Read from the realignment store, or from a mafft_sum_stats csv of older runs. None when neither exists.
+	"""
+	stats = realignment_store.load_stats(res_path, model_type, num_msa)
+	if stats is not None:
+		return sum_stat_table(stats)
+	try:
+		return pd.read_csv(res_path+f"mafft_sum_stats_{model_type}.csv", sep="\t")
+	except Exception:
+		return None
+
+def correction_converged(previous, correction, previous_num_msa, tolerance, rmse_floor=ADAPTIVE_RMSE_FLOOR):
+	"""
+	True when, between two fits (correction_models.bias_correction), no statistic used in distances
+	(sumstat_to_use of either fit) changed its Pearson correlation by more than tolerance, or its cv rmse by
+	more than tolerance plus the sampling noise of the estimate (1/sqrt(previous_num_msa)), relative to
+	the previous rmse or to rmse_floor when it is smaller.
+	"""
+	used = np.isin(correction.sstat_cols, list(set(previous.sumstat_to_use) | set(correction.sumstat_to_use)))
+	model, previous_model = correction.model, previous.model
+	rmse_change = np.abs(model.cv_rmse - previous_model.cv_rmse)/np.maximum(previous_model.cv_rmse, rmse_floor)
+	rmse_tolerance = tolerance + 1/np.sqrt(previous_num_msa)
+	# a statistic without a correlation (a constant one) has none in either fit
+	pearson_change = np.abs(np.nan_to_num(model.pearson, nan=0) - np.nan_to_num(previous_model.pearson, nan=0))
+	return bool(np.all(rmse_change[used] <= rmse_tolerance) and np.all(pearson_change[used] <= tolerance))
+
+def adaptive_realign_msas(res_path, real_alignments_filename, tree_filename, align_list, max_sim_seq_len,
+						  model_type, submodel_params, df_sim, filter_p):
+	"""
+	realigns the simulated alignments in increments, refitting the correction models after each one,
+	until the cv rmse and Pearson quality of the statistics used in distances are stable (see correction_converged)
+	or all alignments are used.
+	Returns the number of alignments used, always the first ones of align_list, and the last fitted
+	correction (a correction_models.bias_correction), which is the final one.
+	"""
+	increment = submodel_params.get("adaptive_increment", ADAPTIVE_INCREMENT)
+	tolerance = submodel_params.get("adaptive_tolerance", ADAPTIVE_TOLERANCE)
+	rmse_floor = submodel_params.get("adaptive_rmse_floor", ADAPTIVE_RMSE_FLOOR)
+	num_used = min(submodel_params.get("adaptive_min_msas", ADAPTIVE_MIN_MSAS), len(align_list))
+	previous, previous_num_msa = None, None
+	while True:
+		realign_msas(res_path, real_alignments_filename, tree_filename, align_list, max_sim_seq_len,
+					 model_type, submodel_params, num_msa=num_used)
+		correction = fit_bias_correction(df_sim, load_mafft_sum_stats(res_path, model_type, num_used),
+										 num_used, filter_p, alignment_flag=False,
+										 correction_method=submodel_params.get("correction_model", "lasso"))
+		if previous is not None and correction_converged(previous, correction, previous_num_msa, tolerance, rmse_floor):
+			break
+		if num_used == len(align_list):
+			logger.info(f'Correction models for model {model_type} did not stabilise, using all MSAs')
+			break
+		previous, previous_num_msa = correction, num_used
+		num_used = min(num_used + increment, len(align_list))
+	logger.info(f'Adaptive realignment for model {model_type}: used {num_used} of {len(align_list)} MSAs')
+	return num_used, correction
 
 def msa_bias_correction(skip_config, clean_run, res_path,
 				 real_alignments_filename,tree_filename,
@@ -341,70 +601,42 @@ def msa_bias_correction(skip_config, clean_run, res_path,
 	num_msa = len(align_list)
 	logger.info(f'Number of simulated MSAs  for model {model_type}: {max_sim_seq_len}')
 	
-	df_mafft = None
-	if skip_config["mafft"]:
-
-		prepare_indelible_control_file(res_path,tree_filename,indelible_out_file_name,
-									   num_msa,max_sim_seq_len,pipeline_path,
-									   indelible_template_file_name, submodel_params)
-		indelible_msa_full_list = run_indelible(res_path)
-
-		# with open(f"sparta_aligned_{model_type}.fasta",'w') as f:
-		# 	f.write("\n\n".join(indelible_msa_full_list))
-		
-		logger.info(f'Number of indelible MSAs for model {model_type}: {len(indelible_msa_full_list)}')
-
-		prepare_sparta_conf_sumstat(res_path, pipeline_path)
-
-		realigned_msa_tmp_filename = 'realigned_msa_tmp.fasta'
-		# use indelible simul results to replace sparta alignment res.
-		# print("Running MAFFT...")
-		for i in range(num_msa):
-			raw_sim_msa = align_list[i]
-			indelible_msa = indelible_msa_full_list[i]
-
-			unaligned_sub_sim_msa, indelible_sparta_msa = add_subs_to_sim_msa(raw_sim_msa,indelible_msa)
-			# write all unaligned msas to file.
-			# continuous_write(interation=i,
-			# 				file_path=f'{res_path}{f"all_unaligned_sims_{model_type}.txt"}',
-			# 				to_write=unaligned_sub_sim_msa)
-			# continuous_write(interation=i,
-			# 				file_path=f'{res_path}{f"indelible_sparta_{model_type}.txt"}',
-			# 				to_write=indelible_sparta_msa)
-			return indelible_sparta_msa
-			# run mafft on unaligned sequences.
-			realigned_msa = reconstruct_msa(res_path=res_path, 
-											unaligned_msa=unaligned_sub_sim_msa,
-											output_name=realigned_msa_tmp_filename,
-											align_mode=submodel_params["mode"],
-											logger=None)
-			# write all realigned msas to file.
-			continuous_write(interation=i,
-							file_path=f'{res_path}{f"all_realigned_sims_{model_type}.txt"}',
-							to_write=realigned_msa)
-			
-			run_sparta_sum_stat(input_msa=realigned_msa,
-								pipeline_path=pipeline_path,
-								conf_file_path=res_path+'sum_stat.conf')
-			
-			df_tmp = pd.read_csv(f'{res_path}tmp_sum_stat.csv',delimiter='\t')
-			df_mafft = df_tmp if i==0 else pd.concat([df_mafft,df_tmp],ignore_index=True) # TODO: save as separate file.
-			os.remove(f'{res_path}tmp_sum_stat.csv')
-		os.remove(f'{res_path}sum_stat.conf')
-		os.remove(f'{res_path}control.txt')
-		# print("Done.")
-		df_mafft.to_csv(f"mafft_sum_stats_{model_type}.csv", sep="\t", index=False)
-		logger.info(f'Done with MAFFT')
+	sim_res_file_path = f'{res_path}SpartaABC_data_name_id{model_type}.posterior_params'
+	# parsed once for fitting and correcting
+	sim_res = load_sim_res_file(sim_res_file_path)
+	with open(res_path+tree_filename,'r') as f:
+		store_key = correction_models.store_key(model_type, realignment_params(submodel_params),
+												submodel_params.get("correction_model", "lasso"), f.read().rstrip(), filter_p)
+	stored_correction = None
+	if skip_config.get("stored_correction", False):
+		stored_correction = correction_models.load_correction(store_key)
+		if stored_correction is None:
+			logger.info(f'No stored correction models for {store_key}, realigning.')
+
+	if stored_correction is not None:
+		logger.info(f'Skipping Mafft, using the stored correction models {store_key}.')
+		apply_bias_correction(res_path, sim_res, stored_correction, model_type)
+	elif skip_config["mafft"] and submodel_params.get("adaptive_realignment", False):
+		num_msa, correction = adaptive_realign_msas(res_path, real_alignments_filename, tree_filename, align_list,
+													max_sim_seq_len, model_type, submodel_params, sim_res[0], filter_p)
+		# the converged fit is applied as is, not fitted again
+		apply_bias_correction(res_path, sim_res, correction, model_type)
+		if skip_config.get("save_correction", False):
+			correction_models.save_correction(store_key, correction)
 	else:
-		logger.info("Skipping Mafft.")
+		if skip_config["mafft"]:
+			realign_msas(res_path, real_alignments_filename, tree_filename, align_list, max_sim_seq_len,
+						 model_type, submodel_params)
+		else:
+			logger.info("Skipping Mafft.")
+		df_mafft = load_mafft_sum_stats(res_path, model_type, num_msa)
 		if df_mafft is None:
-			try:
-				df_mafft = pd.read_csv(res_path+f"mafft_sum_stats_{model_type}.csv", sep="\t")
-			except Exception:
-				logging.error("No mafft results found, please provide mafft_sum_stats file")
-				return
-	sim_res_file_path = f'{res_path}SpartaABC_data_name_id{model_type}.posterior_params'
-	correct_mafft_bias(res_path,sim_res_file_path,df_mafft, num_msa,model_type,filter_p, alignment_flag=False)
+			logging.error(f"No realignment statistics found for model {model_type} (mafft_sum_stats_{model_type}.bin), "
+						  "run the realignment step (skip_config['mafft']) first")
+			return
+		correct_mafft_bias(res_path,sim_res_file_path,df_mafft, num_msa,model_type,filter_p, alignment_flag=False,
+						   correction_method=submodel_params.get("correction_model", "lasso"),
+						   store_key=store_key if skip_config.get("save_correction", False) else None, sim_res=sim_res)
 	if clean_run:
 		remove_large_files(res_path,to_remove=[
 			f"all_realigned_sims_{model_type}.txt",
@@ -413,6 +645,8 @@ def msa_bias_correction(skip_config, clean_run, res_path,
 			f"sparta_aligned_{model_type}.fasta",
 			f"indelible_sparta_{model_type}.txt",
 			f"mafft_sum_stats_{model_type}.csv",
+			f"mafft_sum_stats_{model_type}.bin",
+			f"mafft_sum_stats_{model_type}.json",
 			f"SpartaABC_data_name_id{model_type}.posterior_params",
 			f"used_features_{model_type}.txt"
 		])
@@ -1,7 +1,11 @@
 from sys import maxsize
 import configuration as config
 import os
-import subprocess
+import sys
+import argparse
+import multiprocessing
+import tool_runner
+import summary_statistics as sstats
 
 
 
@@ -24,26 +28,146 @@ def generate_sparta_conf(msa_file_path, res_path):
 	return sparta_conf_file, result_csv
 
 
+def sparta_stats_table(msa_text, sparta_exec_path):
+	"""
+	runs SpartaABC in '_only_real_stats' mode on the fasta text inside a scratch directory
+	and returns the content of its stats table.
+	"""
+	with tool_runner.scratch_dir('sparta_') as scratch_path:
+		msa_path = os.path.join(scratch_path, 'msa.fasta')
+		with open(msa_path,'w') as msa_file:
+			msa_file.write(msa_text)
+		sparta_conf_path, result_csv = generate_sparta_conf(msa_path, scratch_path)
+		tool_runner.run_tool([sparta_exec_path, sparta_conf_path], capture_output=False)
+		with open(result_csv) as result_file:
+			return result_file.read()
+
+
 def get_summary_stats(res_folder_path: str, msa: list, sparta_exec_path: str):
-	msa_path = os.path.join(res_folder_path, 'msa.fasta')
-	with open(msa_path,'w') as msa_file:
-		for idx,seq in enumerate(msa):
-			msa_file.write(f'>{idx}\n')
-			msa_file.write(seq)
-			msa_file.write("\n")
-
-	sparta_conf_path, result_csv = generate_sparta_conf(msa_path, res_folder_path)
-
-	subprocess.call(f'{sparta_exec_path} {sparta_conf_path}', shell=True)
-	with open (result_csv) as result_file:
-		lines = result_file.readlines()
-		return lines[2].split()[6:]
+	"""
+	summary statistics of the msa, as printed by SpartaABC.
+	Computed in-process by summary_statistics, res_folder_path and sparta_exec_path are no longer used.
+	"""
+	return sstats.format_stats(sstats.summary_stats(msa))
+
+
+def get_summary_stats_batch(msas: list):
+	"""
+	summary statistics of many msas (lists of sequences) as a (len(msas), 27) float array.
+	"""
+	return sstats.summary_stats_batch(msas)
 	
 
+MSA_EXTENSIONS = ('.fasta', '.fa', '.fas', '.faa', '.fna', '.aln', '.tfa')
+
+
+def find_msa_files(inputs):
+	"""
+	msa files of the inputs: directories are walked recursively, '.txt' files list one path per line.
+	"""
+	for input_path in inputs:
+		if os.path.isdir(input_path):
+			for dir_path, dir_names, file_names in os.walk(input_path):
+				dir_names.sort()
+				for file_name in sorted(file_names):
+					if file_name.lower().endswith(MSA_EXTENSIONS):
+						yield os.path.join(dir_path, file_name)
+		elif input_path.endswith('.txt'):
+			with open(input_path) as f:
+				for line in f:
+					if line.strip():
+						yield line.strip()
+		else:
+			yield input_path
+
+
+def drop_torn_line(output_path, block_size=1 << 16):
+	"""
+	truncates the output table after its last newline, dropping a line torn by a killed run.
+	"""
+	if not os.path.isfile(output_path):
+		return
+	with open(output_path, 'rb+') as f:
+		end = f.seek(0, os.SEEK_END)
+		position = end
+		while position > 0:
+			start = max(0, position - block_size)
+			f.seek(start)
+			newline = f.read(position - start).rfind(b'\n')
+			if newline >= 0:
+				position = start + newline + 1
+				break
+			position = start
+		if position < end:
+			print(f'dropping a torn line at the end of {output_path}', file=sys.stderr)
+			f.truncate(position)
+
+
+def done_msa_files(output_path):
+	"""
+	msa paths already in the output table.
+	"""
+	if not os.path.isfile(output_path):
+		return set()
+	with open(output_path) as f:
+		next(f, None)
+		return {line.split('\t', 1)[0] for line in f}
+
+
+def summarize_msa_file(args):
+	"""
+	worker of summarize_msa_files. Returns (path, formatted statistics or None, error).
+	"""
+	msa_path, backend, sparta_exec_path = args
+	try:
+		with open(msa_path) as f:
+			msa_text = f.read()
+		if backend == 'sparta':
+			stats = sparta_stats_table(msa_text, sparta_exec_path).split('\n')[2].split()[6:]
+		else:
+			stats = get_summary_stats(None, sstats.fasta_to_rows(msa_text), sparta_exec_path)
+	except Exception as error:
+		return msa_path, None, str(error)
+	return msa_path, stats, None
+
+
+def summarize_msa_files(inputs, output_path, num_workers=1, backend='native', sparta_exec_path=None, chunk_size=64):
+	"""
+	appends the statistics of every msa file not yet in the output table (tab separated,
+	'msa_path' and the SUMMARY_STATS_COLS columns). Files are read in the workers and results
+	are written as they arrive, so memory does not grow with the number of files. A line torn by
+	a killed run is dropped before appending, so that file is summarized again.
+	Returns the number of summarized and failed files.
+	"""
+	drop_torn_line(output_path)
+	done = done_msa_files(output_path)
+	tasks = ((msa_path, backend, sparta_exec_path) for msa_path in find_msa_files(inputs) if msa_path not in done)
+	num_done = num_failed = 0
+	with open(output_path, 'a') as fout:
+		if not done and fout.tell() == 0:
+			fout.write("\t".join(['msa_path'] + config.SUMMARY_STATS_COLS) + "\n")
+		with multiprocessing.Pool(processes=max(1, num_workers)) as pool:
+			for msa_path, stats, error in pool.imap(summarize_msa_file, tasks, chunksize=chunk_size):
+				if stats is None:
+					num_failed += 1
+					print(f'skipping {msa_path}: {error}', file=sys.stderr)
+					continue
+				fout.write("\t".join([msa_path] + stats) + "\n")
+				num_done += 1
+				if num_done % 1000 == 0:
+					fout.flush()
+					print(f'{num_done} msas summarized', file=sys.stderr)
+	return num_done, num_failed
+
+
 if __name__ == "__main__":
-	msa = [
-		"LLLGVNIDHIATLRNARGTa-YPDPVQAAFIAEQAGAd-GITVHLREDRRHITDRDVRILRQTLD-----TRMNLEMAV-------TEEMLAIAVETKPHFCCLVPEKRQEVTTEGGLDVagQRDKMRDACKRLADAGIQVSLFID--ADEEQIKAAAEVGAPFIEIHTGCYADak----",
-		"MRLGVNVDHVATVRQARRTf-EPSPVFAALIAQQAGAd-QITLHLREDRRHIQDRDLELIKELIT-----IPVNLEMAP-------TEEMREIALRVKPDRITLVPERREEITTEGGLDVvsLKEKLKEYLKPIKEAGIEVSLFIE--AQKEQIDASVEVGADAIEIHTGRYANlwn---"
-	]
-	stats = get_summary_stats("/home/elyawy/", msa, "/home/elyawy/development/Msc/Thesis/Working_dir/SpartaABC/SpartaABC")
-	print(stats)
\ No newline at end of file
+	parser = argparse.ArgumentParser(description='Summary statistics of many msa files, in one table.')
+	parser.add_argument('inputs', nargs='+', help='msa files, directories, or .txt lists of msa paths')
+	parser.add_argument('-o', '--output', required=True, help='tab separated table, extended on later runs')
+	parser.add_argument('--num-workers', type=int, default=os.cpu_count())
+	parser.add_argument('--backend', choices=['native', 'sparta'], default='native',
+						help='in-process statistics or the SpartaABC binary')
+	parser.add_argument('--sparta-exec', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SpartaABC'))
+	args = parser.parse_args()
+	num_done, num_failed = summarize_msa_files(args.inputs, args.output, args.num_workers, args.backend, args.sparta_exec)
+	print(f'{num_done} msas summarized, {num_failed} failed')
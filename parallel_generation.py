@@ -0,0 +1,180 @@
+"""
+Helpers for splitting dataset generation across worker processes.
+
+Every worker gets a contiguous sample range, its own scratch directory and
+its own output shard 'all_data_<start>_<end>'. Ranges never cross the
+'num_of_samples_per_file' boundaries, so merge_shards can fold the worker
+shards back into the usual per-file layout once all workers are done.
+
+Progress is recorded in 'manifest.json' of the data set directory, shards are
+written to a temporary file and renamed when complete, so a killed run can be
+restarted with the same arguments and only generates the missing ranges. The
+manifest also keeps the generation settings (seed, priors, simulators), and a
+restart with other settings is refused rather than mixing two data sets.
+"""
+
+import os
+import json
+import shutil
+import logging
+import multiprocessing
+logger = logging.getLogger(__name__)
+
+
+def split_sample_range(num_of_samples, num_of_workers, num_of_samples_per_file):
+	"""
+	Splits [0, num_of_samples) into tasks of at most ceil(num_of_samples/num_of_workers)
+	samples that never cross a per-file boundary.
+	"""
+	chunk_size = max(1, -(-num_of_samples // max(1, num_of_workers)))
+	chunk_size = min(chunk_size, num_of_samples_per_file)
+
+	tasks = []
+	for file_start in range(0, num_of_samples, num_of_samples_per_file):
+		file_end = min(file_start + num_of_samples_per_file, num_of_samples)
+		for start in range(file_start, file_end, chunk_size):
+			tasks.append((start, min(start + chunk_size, file_end)))
+	return tasks
+
+
+def shard_path(data_set_path, start, end, suffix=''):
+	return os.path.join(data_set_path, f'all_data_{start}_{end}{suffix}')
+
+
+def tmp_shard_path(data_set_path, start, end, suffix=''):
+	"""
+	the shard is written here and renamed to shard_path by commit_shard once complete.
+	"""
+	return shard_path(data_set_path, start, end, suffix) + '.tmp'
+
+
+def commit_shard(data_set_path, start, end, suffix=''):
+	"""
+	renames a complete shard (a file, or a directory for binary shards) to its final path.
+	"""
+	final_path = shard_path(data_set_path, start, end, suffix)
+	if os.path.isdir(final_path):
+		# left by a run killed between the rename and record_completed
+		shutil.rmtree(final_path)
+	os.replace(tmp_shard_path(data_set_path, start, end, suffix), final_path)
+
+
+def manifest_path(data_set_path):
+	return os.path.join(data_set_path, 'manifest.json')
+
+
+def _write_manifest(data_set_path, manifest):
+	tmp_path = manifest_path(data_set_path) + '.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump(manifest, f)
+	os.replace(tmp_path, manifest_path(data_set_path))
+
+
+def load_manifest(data_set_path, num_of_samples, num_of_workers, num_of_samples_per_file, settings=None):
+	"""
+	returns the manifest of the data set, creating it on the first run.
+	A restarted run keeps the task split of the first run, whatever its number of workers.
+	settings (a JSON-serializable dict of what the samples depend on) must match those of the first run.
+	"""
+	if os.path.isfile(manifest_path(data_set_path)):
+		with open(manifest_path(data_set_path)) as f:
+			manifest = json.load(f)
+		if (manifest['num_of_samples'], manifest['num_of_samples_per_file']) != (num_of_samples, num_of_samples_per_file):
+			raise ValueError(f"Error: {manifest_path(data_set_path)} was created for {manifest['num_of_samples']} samples "
+							 f"with {manifest['num_of_samples_per_file']} samples per file.")
+		if manifest.get('settings') != settings:
+			stored, current = manifest.get('settings') or {}, settings or {}
+			changed = sorted(key for key in set(stored) | set(current) if stored.get(key) != current.get(key))
+			raise ValueError(f"Error: {manifest_path(data_set_path)} was created with other settings "
+							 f"({', '.join(changed)}), use a new data set directory.")
+		manifest['tasks'] = [tuple(task) for task in manifest['tasks']]
+		manifest['completed'] = [tuple(task) for task in manifest['completed']]
+		logger.info(f"resuming, {len(manifest['completed'])}/{len(manifest['tasks'])} ranges already done")
+		return manifest
+
+	manifest = {'num_of_samples': num_of_samples,
+				'num_of_samples_per_file': num_of_samples_per_file,
+				'settings': settings,
+				'tasks': split_sample_range(num_of_samples, num_of_workers, num_of_samples_per_file),
+				'completed': [],
+				'merged': []}
+	_write_manifest(data_set_path, manifest)
+	return manifest
+
+
+def pending_tasks(manifest):
+	completed = set(manifest['completed'])
+	return [task for task in manifest['tasks'] if task not in completed]
+
+
+def record_completed(data_set_path, manifest, task):
+	manifest['completed'].append(tuple(task))
+	_write_manifest(data_set_path, manifest)
+
+
+def task_seed(base_seed, start):
+	"""
+	Deterministic seed of the task starting at 'start', independent of the worker running it.
+	"""
+	return base_seed + start
+
+
+def _run_task(args):
+	func, task = args
+	return task, func(*task)
+
+
+def run_tasks(func, tasks, num_of_workers):
+	"""
+	Runs func(start, end) for every task. Yields (task, result) as tasks complete.
+	With a single worker everything runs in the calling process.
+	"""
+	if num_of_workers <= 1:
+		for task in tasks:
+			yield task, func(*task)
+		return
+
+	with multiprocessing.Pool(processes=num_of_workers) as pool:
+		for task, result in pool.imap_unordered(_run_task, [(func, task) for task in tasks]):
+			logger.info(f'finished samples {task[0]}-{task[1]}')
+			yield task, result
+
+
+def merge_shards(data_set_path, manifest):
+	"""
+	Concatenates the worker shards of every per-file range into
+	'all_data_<file_start>_<file_start + num_of_samples_per_file>' and removes them.
+	Only runs once all tasks are completed. Merged files are recorded in the manifest.
+	"""
+	if len(pending_tasks(manifest)):
+		logger.info('not merging, some ranges are still missing')
+		return False
+
+	num_of_samples_per_file = manifest['num_of_samples_per_file']
+	files = {}
+	for start, end in sorted(manifest['tasks']):
+		file_start = start - start % num_of_samples_per_file
+		files.setdefault(file_start, []).append((start, end))
+
+	for file_start, file_tasks in files.items():
+		merged_path = shard_path(data_set_path, file_start, file_start + num_of_samples_per_file)
+		shard_paths = [shard_path(data_set_path, start, end) for start, end in file_tasks]
+		if file_start in manifest['merged']:
+			# a previous run may have stopped before removing the worker shards
+			for path in shard_paths:
+				if path != merged_path and os.path.isfile(path):
+					os.remove(path)
+			continue
+		if shard_paths != [merged_path]:
+			with open(merged_path + '.tmp', 'wb') as fout:
+				for path in shard_paths:
+					with open(path, 'rb') as fin:
+						shutil.copyfileobj(fin, fout)
+			os.replace(merged_path + '.tmp', merged_path)
+		manifest['merged'].append(file_start)
+		_write_manifest(data_set_path, manifest)
+		for path in shard_paths:
+			if path != merged_path:
+				os.remove(path)
+		logger.info(f'merged {len(shard_paths)} shards into {merged_path}')
+	return True
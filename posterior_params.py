@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass reader of the SpartaABC posterior_params files.
+
+A posterior_params file is
+	the column names
+	a blank line
+	the input msa row ('input_msa' and its statistics) and the weights row
+	one row per simulation
+	a blank line and 6 lines of posterior expectations (the footer)
+posterior_params_reader parses the head, then streams the simulation rows straight
+into pandas: reading stops at the blank line of the footer, which is kept, so
+the file is read once whatever is asked of it.
+
+read_posterior_params also keeps the parsed table in a sidecar directory
+(<file>.npcache: one raw binary file per column), reused until the size or
+modification time of the file changes, so re-runs skip the text parsing. The
+sidecar is filled chunk by chunk on the first read and the table is always
+returned memory-mapped from it, so reading a large file does not hold it in memory.
+"""
+
+import io
+import os
+import json
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+
+
+HEAD_LINES = 4
+FOOTER_LINES = 7
+SIDECAR_SUFFIX = '.npcache'
+# bump when the sidecar layout changes, older sidecars are then parsed again
+SIDECAR_VERSION = 2
+# simulation rows parsed at a time when writing a sidecar
+CHUNK_ROWS = 50000
+
+
+def parse_head(head):
+	"""
+	the input msa and weights rows of the head lines, typed as pandas reads them from the whole file.
+	"""
+	return pd.read_csv(io.StringIO(head), delimiter='\t')
+
+
+class _body_stream:
+	"""
+	file-like view of the simulation rows, ending at the blank line before the footer.
+	"""
+	def __init__(self, f):
+		self.f = f
+		self.footer = None
+		self._ended_with_newline = True
+
+	def read(self, size=-1):
+		if self.footer is not None:
+			return ''
+		data = self.f.read(size if size and size > 0 else -1)
+		if not data:
+			self.footer = []
+			return ''
+		if self._ended_with_newline and data[0] == '\n':
+			end = 0
+		else:
+			end = data.find('\n\n')
+			end = -1 if end < 0 else end + 1
+		if end < 0:
+			self._ended_with_newline = data[-1] == '\n'
+			return data
+		self.footer = ['\n'] + (data[end + 1:] + self.f.read()).splitlines(keepends=True)
+		return data[:end]
+
+
+class posterior_params_reader:
+	"""
+	reads the head of the file on opening, then the simulation rows with read_body.
+	The footer lines are available once the body was read to its end.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path)
+		self.head = "".join(self.f.readline() for _ in range(HEAD_LINES))
+		self.columns = self.head.split('\n')[0].split('\t')
+		self.meta = parse_head(self.head)
+		self._body = _body_stream(self.f)
+
+	@property
+	def footer(self):
+		"""
+		the footer lines, reading past the rest of the body when it was not read to its end.
+		"""
+		while self._body.read(1 << 20):
+			pass
+		return self._body.footer
+
+	def read_body(self, usecols=None, dtype=None, skip_rows=0, nrows=None, chunksize=None):
+		"""
+		the simulation rows [skip_rows, skip_rows + nrows) as a DataFrame, or an iterator of
+		DataFrames of chunksize rows. usecols restricts the parsed columns and dtype
+		(e.g. np.float32) applies to all of them. Called once, before anything else is read.
+		"""
+		for _ in range(skip_rows):
+			self.f.readline()
+		return pd.read_csv(self._body, delimiter='\t', header=None, names=self.columns, usecols=usecols,
+						   dtype=dtype, nrows=nrows, chunksize=chunksize)
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+def sidecar_enabled():
+	return os.environ.get("SPARTA_SIDECAR", "1") != "0"
+
+
+def sidecar_path(path):
+	return path + SIDECAR_SUFFIX
+
+
+def _source_stamp(path):
+	stat = os.stat(path)
+	return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _column_path(sidecar, i):
+	return os.path.join(sidecar, f'{i}.bin')
+
+
+def write_sidecar(path, reader, chunk_rows=CHUNK_ROWS):
+	"""
+	parses the simulation rows of a fresh reader of the file chunk_rows at a time, appending every column
+	to its raw file in the sidecar, then writes meta.json (the stamp of the source it was parsed from,
+	the column names and dtypes, the number of rows, the head lines and the footer). A column parsed as
+	integers in early chunks and floats in later ones is promoted, as a whole-file parse would type it.
+	Returns False when no sidecar was written (non numeric columns, or an unwritable directory).
+	"""
+	stamp = _source_stamp(path)
+	final_path = sidecar_path(path)
+	# private to the process, concurrent readers of the same file each write their own
+	tmp_path = f'{final_path}.tmp{os.getpid()}'
+	try:
+		if os.path.isdir(tmp_path):
+			shutil.rmtree(tmp_path)
+		os.makedirs(tmp_path)
+		dtypes = {}
+		num_rows = 0
+		for chunk in reader.read_body(chunksize=chunk_rows):
+			for i, col in enumerate(chunk.columns):
+				values = chunk[col].values
+				if values.dtype == object:
+					logger.info(f'{path} has non numeric simulation columns, no sidecar written')
+					shutil.rmtree(tmp_path)
+					return False
+				dtype = dtypes.get(col, values.dtype)
+				promoted = np.result_type(dtype, values.dtype)
+				if promoted != dtype:
+					np.fromfile(_column_path(tmp_path, i), dtype=dtype).astype(promoted).tofile(_column_path(tmp_path, i))
+				with open(_column_path(tmp_path, i), 'ab') as f:
+					values.astype(promoted, copy=False).tofile(f)
+				dtypes[col] = promoted
+			num_rows += len(chunk)
+		with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+			json.dump({'version': SIDECAR_VERSION, 'source': stamp, 'columns': reader.columns,
+					   'dtypes': [np.dtype(dtypes.get(col, np.float64)).str for col in reader.columns],
+					   'num_rows': num_rows, 'head': reader.head, 'footer': reader.footer}, f)
+		if os.path.isdir(final_path):
+			shutil.rmtree(final_path)
+		os.replace(tmp_path, final_path)
+	except OSError as e:
+		logger.warning(f'could not write the sidecar of {path}: {e}')
+		shutil.rmtree(tmp_path, ignore_errors=True)
+		return False
+	return True
+
+
+def _map_column(sidecar, i, dtype, num_rows):
+	if num_rows == 0:
+		return np.zeros(0, dtype=dtype)
+	# copy-on-write map, so the table stays writable without touching the sidecar
+	return np.memmap(_column_path(sidecar, i), dtype=dtype, mode='c', shape=(num_rows,))
+
+
+def read_sidecar(path, usecols=None):
+	"""
+	(columns, meta, body, footer) from the sidecar of the file, None when there is none or the
+	file changed since it was written. Columns are memory-mapped, only usecols are mapped.
+	"""
+	meta_json = os.path.join(sidecar_path(path), 'meta.json')
+	if not os.path.isfile(meta_json):
+		return None
+	with open(meta_json) as f:
+		sidecar = json.load(f)
+	if sidecar.get('version') != SIDECAR_VERSION or sidecar['source'] != _source_stamp(path):
+		logger.info(f'{path} changed, its sidecar is stale')
+		return None
+	columns = sidecar['columns']
+	body = pd.DataFrame({col: _map_column(sidecar_path(path), i, np.dtype(dtype), sidecar['num_rows'])
+						 for i, (col, dtype) in enumerate(zip(columns, sidecar['dtypes']))
+						 if usecols is None or col in usecols}, copy=False)
+	return columns, parse_head(sidecar['head']), body, sidecar['footer']
+
+
+def remove_sidecar(path):
+	if os.path.isdir(sidecar_path(path)):
+		shutil.rmtree(sidecar_path(path))
+
+
+def read_posterior_params(path, usecols=None, dtype=None):
+	"""
+	reads the file in one pass. Returns (columns, meta, body, footer): the column names, the input msa
+	and weights rows, the simulation rows (restricted to usecols, as dtype) and the footer lines.
+	The table is parsed into a sidecar (see write_sidecar) on the first read and memory-mapped from it,
+	then and while the file is unchanged. Set SPARTA_SIDECAR=0 to always parse the text into memory.
+	"""
+	if sidecar_enabled():
+		cached = read_sidecar(path, usecols)
+		if cached is None:
+			with posterior_params_reader(path) as reader:
+				written = write_sidecar(path, reader)
+			cached = read_sidecar(path, usecols) if written else None
+		if cached is not None:
+			columns, meta, body, footer = cached
+			return columns, meta, (body if dtype is None else body.astype(dtype)), footer
+
+	with posterior_params_reader(path) as reader:
+		return reader.columns, reader.meta, reader.read_body(usecols, dtype), reader.footer
+
+
+def read_meta(path):
+	"""
+	the input msa and weights rows only.
+	"""
+	with posterior_params_reader(path) as reader:
+		return reader.meta
+
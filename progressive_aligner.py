@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+In-process progressive multiple sequence aligner, for realigning the small simulated
+msas of the bias correction without launching an external aligner.
+
+	1. guide tree - UPGMA on k-mer distances (1 - fraction of shared k-mers), as MAFFT's first pass
+	2. merging    - profiles are merged in guide tree order by a global affine gap alignment
+	                (Gotoh) of their columns, scored by the average substitution score of all
+	                residue pairs of the two columns (BLOSUM62, or +5/-4 for nucleotides)
+The dynamic programming runs row by row with numpy: the match and vertical gap states of a
+row are elementwise, and the horizontal gap state is a running maximum along the row.
+
+usage: python progressive_aligner.py <unaligned.fasta> [nuc|amino]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from Bio.Align import substitution_matrices
+
+
+# bump when alignments change, cached realignments are keyed by it (see result_cache)
+VERSION = '1'
+GAP_OPEN = -10.0
+GAP_EXTEND = -0.5
+NUC_MATCH = 5.0
+NUC_MISMATCH = -4.0
+KMER_SIZE = {'nuc': 6, 'amino': 3}
+NEG_INF = -1e18
+# traceback states
+MATCH, GAP_IN_B, GAP_IN_A = 0, 1, 2
+
+
+def scoring(mode):
+	"""
+	(alphabet, substitution matrix) of the mode. Letters out of the alphabet are scored as its last one
+	(X for amino acids, N for nucleotides).
+	"""
+	if mode == 'amino':
+		matrix = substitution_matrices.load('BLOSUM62')
+		alphabet = matrix.alphabet
+		scores = np.array(matrix, dtype=float)
+		# keep X last, so unknown letters map to it
+		order = [alphabet.index(letter) for letter in alphabet if letter not in 'X*'] + [alphabet.index('X')]
+		return "".join(alphabet[i] for i in order), scores[np.ix_(order, order)]
+	alphabet = 'ACGTN'
+	scores = np.full((5, 5), NUC_MISMATCH)
+	np.fill_diagonal(scores, NUC_MATCH)
+	scores[4, :] = scores[:, 4] = 0
+	return alphabet, scores
+
+
+def encode(sequences, alphabet):
+	"""
+	sequences as int arrays of alphabet indices.
+	"""
+	lookup = np.full(256, len(alphabet) - 1, dtype=np.int64)
+	for i, letter in enumerate(alphabet):
+		lookup[ord(letter)] = i
+		lookup[ord(letter.lower())] = i
+	return [lookup[np.frombuffer(sequence.encode(), dtype=np.uint8)] for sequence in sequences]
+
+
+def kmer_counts(codes, alphabet_size, k):
+	if len(codes) < k:
+		return np.zeros(alphabet_size**k, dtype=np.int64)
+	ids = np.zeros(len(codes) - k + 1, dtype=np.int64)
+	for t in range(k):
+		ids = ids*alphabet_size + codes[t:len(codes) - k + 1 + t]
+	return np.bincount(ids, minlength=alphabet_size**k)
+
+
+def kmer_distances(encoded, alphabet_size, k):
+	"""
+	(n, n) matrix of 1 - shared k-mers / k-mers of the shorter sequence.
+	"""
+	counts = np.array([kmer_counts(codes, alphabet_size, k) for codes in encoded])
+	num_kmers = counts.sum(axis=1)
+	shared = np.array([np.minimum(counts[i], counts).sum(axis=1) for i in range(len(encoded))])
+	shorter = np.minimum(num_kmers[:, np.newaxis], num_kmers[np.newaxis, :])
+	return 1 - np.divide(shared, shorter, out=np.zeros(shared.shape), where=shorter > 0)
+
+
+def upgma(distances):
+	"""
+	merge order of the UPGMA tree of a distance matrix: a list of (cluster, cluster) pairs,
+	clusters 0..n-1 being the leaves and n, n+1, ... the merged ones in order.
+	"""
+	n = len(distances)
+	distances = distances.astype(float).copy()
+	np.fill_diagonal(distances, np.inf)
+	ids = list(range(n))
+	sizes = [1]*n
+	merges = []
+	active = np.ones(n, dtype=bool)
+	for new_id in range(n, 2*n - 1):
+		masked = np.where(active[:, np.newaxis] & active[np.newaxis, :], distances, np.inf)
+		i, j = np.unravel_index(np.argmin(masked), masked.shape)
+		merges.append((ids[i], ids[j]))
+		# the merged cluster takes slot i
+		distances[i, :] = distances[:, i] = (sizes[i]*distances[i] + sizes[j]*distances[j])/(sizes[i] + sizes[j])
+		distances[i, i] = np.inf
+		active[j] = False
+		ids[i] = new_id
+		sizes[i] += sizes[j]
+	return merges
+
+
+def profile_frequencies(profile, alphabet_size):
+	"""
+	(num_columns, alphabet_size) letter frequencies of a (num_seqs, num_columns) profile, gaps being -1.
+	"""
+	num_seqs, num_columns = profile.shape
+	frequencies = np.zeros((num_columns, alphabet_size))
+	columns = np.broadcast_to(np.arange(num_columns), profile.shape)
+	residues = profile >= 0
+	np.add.at(frequencies, (columns[residues], profile[residues]), 1)
+	return frequencies/num_seqs
+
+
+def align_profiles(profile_a, profile_b, scores, gap_open=GAP_OPEN, gap_extend=GAP_EXTEND):
+	"""
+	global affine gap alignment of two profiles. Returns the merged profile, rows of a then rows of b.
+	"""
+	alphabet_size = len(scores)
+	column_scores = profile_frequencies(profile_a, alphabet_size) @ scores @ profile_frequencies(profile_b, alphabet_size).T
+	len_a, len_b = column_scores.shape
+	positions = np.arange(len_b + 1)
+
+	# previous row of the three states, and the traceback of every cell
+	match = np.full(len_b + 1, NEG_INF)
+	gap_in_b = np.full(len_b + 1, NEG_INF)
+	match[0] = 0
+	gap_in_a = np.full(len_b + 1, NEG_INF)
+	gap_in_a[1:] = gap_open + (positions[1:] - 1)*gap_extend
+	trace = np.zeros((3, len_a + 1, len_b + 1), dtype=np.uint8)
+	trace[GAP_IN_A, 0, 2:] = GAP_IN_A
+	for i in range(1, len_a + 1):
+		states = np.stack([match, gap_in_b, gap_in_a])
+		best = states.argmax(axis=0)
+		new_match = np.full(len_b + 1, NEG_INF)
+		new_match[1:] = states.max(axis=0)[:-1] + column_scores[i - 1]
+		trace[MATCH, i, 1:] = best[:-1]
+
+		opened = np.maximum(match, gap_in_a) + gap_open
+		extended = gap_in_b + gap_extend
+		new_gap_in_b = np.maximum(opened, extended)
+		trace[GAP_IN_B, i] = np.where(extended > opened, GAP_IN_B, np.where(match >= gap_in_a, MATCH, GAP_IN_A))
+
+		# horizontal gaps: max over k < j of max(match, gap_in_b)[k] + open + (j - 1 - k)*extend
+		closed = np.maximum(new_match, new_gap_in_b)
+		running = np.maximum.accumulate(closed - positions*gap_extend)
+		new_gap_in_a = np.full(len_b + 1, NEG_INF)
+		new_gap_in_a[1:] = running[:-1] + gap_open + (positions[1:] - 1)*gap_extend
+		opened = closed[:-1] + gap_open
+		extended = new_gap_in_a[:-1] + gap_extend
+		trace[GAP_IN_A, i, 1:] = np.where(extended > opened, GAP_IN_A,
+										  np.where(new_match[:-1] >= new_gap_in_b[:-1], MATCH, GAP_IN_B))
+		match, gap_in_b, gap_in_a = new_match, new_gap_in_b, new_gap_in_a
+
+	# traceback from the best final state, collecting column indices (-1 for gap columns)
+	state = int(np.argmax([match[len_b], gap_in_b[len_b], gap_in_a[len_b]]))
+	i, j = len_a, len_b
+	columns_a, columns_b = [], []
+	while i > 0 or j > 0:
+		if i == 0:
+			state = GAP_IN_A
+		elif j == 0:
+			state = GAP_IN_B
+		previous = trace[state, i, j]
+		if state == MATCH:
+			i, j = i - 1, j - 1
+			columns_a.append(i)
+			columns_b.append(j)
+		elif state == GAP_IN_B:
+			i -= 1
+			columns_a.append(i)
+			columns_b.append(-1)
+		else:
+			j -= 1
+			columns_a.append(-1)
+			columns_b.append(j)
+		state = previous
+	columns_a = np.array(columns_a[::-1])
+	columns_b = np.array(columns_b[::-1])
+
+	merged_a = np.where(columns_a >= 0, profile_a[:, np.maximum(columns_a, 0)], -1)
+	merged_b = np.where(columns_b >= 0, profile_b[:, np.maximum(columns_b, 0)], -1)
+	return np.vstack([merged_a, merged_b])
+
+
+def align(sequences, mode):
+	"""
+	aligned rows of the sequences, in input order.
+	"""
+	if len(sequences) < 2:
+		return list(sequences)
+	alphabet, scores = scoring(mode)
+	encoded = encode(sequences, alphabet)
+	merges = upgma(kmer_distances(encoded, len(alphabet), KMER_SIZE[mode]))
+
+	# every cluster is a (sequence indices, profile) pair
+	clusters = {i: ([i], codes[np.newaxis, :]) for i, codes in enumerate(encoded)}
+	for new_id, (cluster_a, cluster_b) in enumerate(merges, start=len(sequences)):
+		members_a, profile_a = clusters.pop(cluster_a)
+		members_b, profile_b = clusters.pop(cluster_b)
+		clusters[new_id] = (members_a + members_b, align_profiles(profile_a, profile_b, scores))
+	members, profile = clusters.popitem()[1]
+
+	letters = np.frombuffer(alphabet.encode() + b'-', dtype=np.uint8)
+	rows = [None]*len(sequences)
+	for member, row in zip(members, profile):
+		rows[member] = letters[row].tobytes().decode()
+	# letters out of the alphabet were aligned as its last one, put them back
+	for i, sequence in enumerate(sequences):
+		residues = np.frombuffer(rows[i].encode(), dtype=np.uint8).copy()
+		residues[residues != ord('-')] = np.frombuffer(sequence.encode(), dtype=np.uint8)
+		rows[i] = residues.tobytes().decode()
+	return rows
+
+
+if __name__ == "__main__":
+	import realigners
+	with open(sys.argv[1]) as f:
+		names, sequences = realigners.parse_fasta(f.read())
+	print(realigners.to_fasta(names, align(sequences, sys.argv[2] if len(sys.argv) > 2 else 'amino')), end='')
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Realigner backends of the bias correction.
+
+Every backend turns an unaligned fasta text into an aligned one (one line per
+sequence, in input order) for a mode ('nuc' or 'amino'):
+	mafft           - mafft --auto, the aligner the correction was built with
+	mafft_fast      - MAFFT FFT-NS-2 (--retree 2 --maxiterate 0)
+	mafft_accurate  - MAFFT L-INS-i (--localpair --maxiterate 1000)
+	muscle          - MUSCLE (v3 and v5 command lines)
+	clustalw        - ClustalW 2
+	center_star     - in-process center star alignment (Biopython pairwise aligner)
+	progressive     - in-process progressive alignment (see progressive_aligner)
+The backend is chosen per run with submodel_params['realigner'] (default 'mafft').
+"""
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+from Bio.Align import PairwiseAligner, substitution_matrices
+
+import tool_runner
+import progressive_aligner
+import summary_statistics as sstats
+
+
+def parse_fasta(fasta):
+	"""
+	(names, sequences) of a fasta text, sequences may span several lines.
+	"""
+	names = []
+	for record in fasta.split('>')[1:]:
+		names.append(record.partition('\n')[0].strip())
+	return names, sstats.fasta_to_rows(fasta)
+
+
+def to_fasta(names, sequences):
+	return "".join(f">{name}\n{sequence}\n" for name, sequence in zip(names, sequences))
+
+
+def in_input_order(aligned_msa, names):
+	"""
+	one line per sequence, in the order of names (MUSCLE and ClustalW reorder their output).
+	"""
+	aligned_names, aligned_sequences = parse_fasta(aligned_msa)
+	by_name = dict(zip(aligned_names, aligned_sequences))
+	return to_fasta(names, [by_name[name] for name in names])
+
+
+class realigner:
+	name = None
+	# aligns in the Python process (and holds the GIL) rather than in an external tool
+	in_process = False
+
+	def version(self):
+		"""
+		identifies the aligner and its settings in cache keys.
+		"""
+		return self.name
+
+	def align(self, unaligned_msa, mode):
+		raise NotImplementedError
+
+
+class mafft_realigner(realigner):
+	def __init__(self, name, extra_args, executable='mafft'):
+		self.name = name
+		self.extra_args = tuple(extra_args)
+		self.executable = executable
+
+	def version(self):
+		return f"{tool_runner.tool_version(self.executable)} {' '.join(self.extra_args)}"
+
+	def align(self, unaligned_msa, mode):
+		names, _ = parse_fasta(unaligned_msa)
+		return in_input_order(tool_runner.run_mafft(unaligned_msa, mode, self.extra_args, self.executable), names)
+
+
+class muscle_realigner(realigner):
+	name = 'muscle'
+
+	def __init__(self, executable='muscle'):
+		self.executable = executable
+
+	def version(self):
+		return tool_runner.tool_version(self.executable, '-version')
+
+	def align(self, unaligned_msa, mode):
+		names, _ = parse_fasta(unaligned_msa)
+		with tool_runner.scratch_dir('muscle_') as path:
+			in_path, out_path = os.path.join(path, 'in.fasta'), os.path.join(path, 'out.fasta')
+			with open(in_path, 'w') as f:
+				f.write(unaligned_msa)
+			if 'muscle 5' in self.version().lower():
+				args = [self.executable, '-align', in_path, '-output', out_path]
+			else:
+				args = [self.executable, '-in', in_path, '-out', out_path, '-quiet']
+			tool_runner.run_tool(args, cwd=path, capture_output=False)
+			with open(out_path) as f:
+				return in_input_order(f.read(), names)
+
+
+class clustalw_realigner(realigner):
+	name = 'clustalw'
+
+	def __init__(self, executable='clustalw2'):
+		self.executable = executable
+
+	def version(self):
+		return tool_runner.tool_version(self.executable, '-help').split('\n')[0]
+
+	def align(self, unaligned_msa, mode):
+		names, _ = parse_fasta(unaligned_msa)
+		with tool_runner.scratch_dir('clustalw_') as path:
+			in_path, out_path = os.path.join(path, 'in.fasta'), os.path.join(path, 'out.fasta')
+			with open(in_path, 'w') as f:
+				f.write(unaligned_msa)
+			tool_runner.run_tool([self.executable, f'-INFILE={in_path}', f'-OUTFILE={out_path}', '-OUTPUT=FASTA',
+								  f'-TYPE={"PROTEIN" if mode == "amino" else "DNA"}', '-OUTORDER=INPUT', '-QUIET'],
+								 cwd=path, capture_output=False)
+			with open(out_path) as f:
+				return in_input_order(f.read(), names)
+
+
+def pairwise_aligner(mode):
+	"""
+	global aligner with the EMBOSS needle defaults (BLOSUM62 or EDNAFULL-like scores, gaps -10/-0.5).
+	"""
+	aligner = PairwiseAligner(mode='global')
+	if mode == 'amino':
+		aligner.substitution_matrix = substitution_matrices.load('BLOSUM62')
+	else:
+		aligner.match_score = 5
+		aligner.mismatch_score = -4
+	aligner.open_gap_score = -10
+	aligner.extend_gap_score = -0.5
+	return aligner
+
+
+class center_star_realigner(realigner):
+	"""
+	aligns every sequence to the center (the sequence with the best total pairwise score)
+	and merges the pairwise alignments, keeping every gap of the center.
+	"""
+	name = 'center_star'
+	in_process = True
+
+	def align(self, unaligned_msa, mode):
+		names, sequences = parse_fasta(unaligned_msa)
+		if len(sequences) < 2:
+			return to_fasta(names, sequences)
+		aligner = pairwise_aligner(mode)
+		totals = [sum(aligner.score(seq, other) for j, other in enumerate(sequences) if j != i)
+				  for i, seq in enumerate(sequences)]
+		center = sequences[max(range(len(sequences)), key=totals.__getitem__)]
+
+		# per sequence: the residues inserted before every center position, and the one aligned to it
+		insertions, aligned = [], []
+		for seq in sequences:
+			alignment = aligner.align(center, seq)[0]
+			seq_insertions = [[] for _ in range(len(center) + 1)]
+			seq_aligned = []
+			for center_char, seq_char in zip(alignment[0], alignment[1]):
+				if center_char == '-':
+					seq_insertions[len(seq_aligned)].append(seq_char)
+				else:
+					seq_aligned.append(seq_char)
+			insertions.append(seq_insertions)
+			aligned.append(seq_aligned)
+		max_insertions = [max(len(seq_insertions[pos]) for seq_insertions in insertions)
+						  for pos in range(len(center) + 1)]
+
+		rows = []
+		for seq_insertions, seq_aligned in zip(insertions, aligned):
+			row = []
+			for pos, width in enumerate(max_insertions):
+				row.append("".join(seq_insertions[pos]).ljust(width, '-'))
+				if pos < len(center):
+					row.append(seq_aligned[pos])
+			rows.append("".join(row))
+		return to_fasta(names, rows)
+
+
+class progressive_realigner(realigner):
+	name = 'progressive'
+	in_process = True
+
+	def version(self):
+		return f'{self.name} {progressive_aligner.VERSION}'
+
+	def align(self, unaligned_msa, mode):
+		names, sequences = parse_fasta(unaligned_msa)
+		return to_fasta(names, progressive_aligner.align(sequences, mode))
+
+
+REALIGNERS = {
+	'mafft': lambda: mafft_realigner('mafft', ['--auto']),
+	'mafft_fast': lambda: mafft_realigner('mafft_fast', ['--retree', '2', '--maxiterate', '0']),
+	'mafft_accurate': lambda: mafft_realigner('mafft_accurate', ['--localpair', '--maxiterate', '1000']),
+	'muscle': muscle_realigner,
+	'clustalw': clustalw_realigner,
+	'center_star': center_star_realigner,
+	'progressive': progressive_realigner,
+}
+
+
+def get_realigner(name='mafft'):
+	if name not in REALIGNERS:
+		raise ValueError(f"Error: unknown realigner {name}, choose one of {', '.join(REALIGNERS)}.")
+	return REALIGNERS[name]()
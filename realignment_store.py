@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only store of the summary statistics of the bias correction realignments.
+
+Realigned msas are summarized in batches and appended as fixed size float64
+records (index of the msa in alignments_<model>.fasta, then the
+SUMMARY_STATS_COLS statistics), flushed after every batch. A killed run
+therefore loses at most the msas of the current batch (whose realignments are
+still in the result cache), and the next run only realigns the indices missing
+from the store. A torn record at the end of the file is dropped
+when the store is opened.
+
+The store is two files:
+	mafft_sum_stats_<model>.bin  - the records
+	mafft_sum_stats_<model>.json - what the records were computed from (alignments file hash, tree,
+	                               substitution model parameters, realigner, mode, statistics
+	                               version). A store whose meta does not match the current run is
+	                               started over.
+"""
+
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS
+
+
+RECORD_COLS = ['INDEX'] + SUMMARY_STATS_COLS
+RECORD_BYTES = 8*len(RECORD_COLS)
+
+
+def store_path(res_path, model_type):
+	return os.path.join(res_path, f'mafft_sum_stats_{model_type}.bin')
+
+
+def meta_path(res_path, model_type):
+	return os.path.join(res_path, f'mafft_sum_stats_{model_type}.json')
+
+
+def file_sha256(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def read_records(path):
+	"""
+	(num_records, len(RECORD_COLS)) float64 array of the complete records of a store file.
+	"""
+	if not os.path.isfile(path):
+		return np.zeros((0, len(RECORD_COLS)))
+	num_records = os.path.getsize(path)//RECORD_BYTES
+	return np.fromfile(path, dtype=np.float64, count=num_records*len(RECORD_COLS)).reshape(num_records, len(RECORD_COLS))
+
+
+class realignment_store:
+	def __init__(self, res_path, model_type, meta):
+		"""
+		opens the store of the model for appending. meta describes the run (see the module docstring),
+		a store written for another meta is discarded.
+		"""
+		self.path = store_path(res_path, model_type)
+		self.meta_path = meta_path(res_path, model_type)
+		# as read back from the file (tuples become lists), so that it compares equal
+		self.meta = json.loads(json.dumps(dict(meta, cols=RECORD_COLS)))
+
+		stored_meta = None
+		if os.path.isfile(self.meta_path):
+			with open(self.meta_path) as f:
+				stored_meta = json.load(f)
+		if stored_meta != self.meta:
+			if stored_meta is not None:
+				logger.info(f'{self.path} was written for another run, starting over')
+			with open(self.meta_path, 'w') as f:
+				json.dump(self.meta, f)
+			open(self.path, 'wb').close()
+
+		# drop a record torn by a crash during its write
+		size = os.path.getsize(self.path)
+		if size % RECORD_BYTES:
+			os.truncate(self.path, size - size % RECORD_BYTES)
+		self.done = set(read_records(self.path)[:, 0].astype(int).tolist())
+		self._file = open(self.path, 'ab')
+
+	def __len__(self):
+		return len(self.done)
+
+	def pending(self, num_msa):
+		"""
+		indices in [0, num_msa) without a record yet.
+		"""
+		return [i for i in range(num_msa) if i not in self.done]
+
+	def append(self, index, stats):
+		self.extend([index], [stats])
+
+	def extend(self, indices, stats):
+		"""
+		appends the records of many msas, stats being one row per index.
+		"""
+		if not len(indices):
+			return
+		records = np.column_stack([indices, stats]).astype(np.float64)
+		self._file.write(records.tobytes())
+		self._file.flush()
+		self.done.update(int(index) for index in indices)
+
+	def close(self):
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+def load_stats(res_path, model_type, num_msa=None):
+	"""
+	(num_msa, num_stats) statistics of the store ordered by msa index, or None when there is no store.
+	Raises ValueError when one of the first num_msa (default: all stored) msas is missing.
+	"""
+	path = store_path(res_path, model_type)
+	if not os.path.isfile(path):
+		return None
+	records = read_records(path)
+	indices = records[:, 0].astype(int)
+	num_msa = len(records) if num_msa is None else num_msa
+	stats = np.full((num_msa, len(SUMMARY_STATS_COLS)), np.nan)
+	in_range = indices < num_msa
+	stats[indices[in_range]] = records[in_range, 1:]
+	missing = np.flatnonzero(np.isnan(stats).any(axis=1))
+	if len(missing):
+		raise ValueError(f"Error: {path} is missing {len(missing)} of {num_msa} msas, rerun the bias correction realignment.")
+	return stats
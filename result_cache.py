@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent content-addressed cache of external tool results (realignments).
+
+Entries live in a single SQLite file and are keyed by the sha256 of the
+namespace, the version of the tool producing the value and the input bytes,
+so a new aligner version never sees old results. Failed or empty results are
+never stored. The cache is bounded by size: once it grows past max_bytes the
+least recently used entries are evicted. Lookups do not write: hits, misses and
+the use times of hit entries are kept in memory and written every FLUSH_EVERY
+lookups and at exit, so parameter sweeps running in many processes still share
+one count in the file.
+
+The file is $SPARTA_CACHE_DIR/results.sqlite, by default on disk in
+$XDG_CACHE_HOME/sparta (~/.cache/sparta), so it survives reboots. SQLite's WAL
+mode needs a local filesystem: when the home directory is on a network mount,
+point SPARTA_CACHE_DIR to a local disk. A tmpfs directory (e.g. /dev/shm/sparta)
+is only used when set there explicitly, entries then live in memory until reboot.
+Set SPARTA_CACHE=0 to disable caching.
+
+usage: python result_cache.py [stats|clear]
+"""
+
+import os
+import sys
+import time
+import atexit
+import sqlite3
+import threading
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 2*1024**3
+CACHE_FILE_NAME = 'results.sqlite'
+FLUSH_EVERY = 1000
+
+
+def cache_dir():
+	default = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser('~'), '.cache'), 'sparta')
+	return os.environ.get("SPARTA_CACHE_DIR", default)
+
+
+def cache_key(namespace, version, data):
+	"""
+	hex digest of namespace, version and the input data (str or bytes).
+	"""
+	if isinstance(data, str):
+		data = data.encode()
+	digest = hashlib.sha256(f'{namespace}\0{version}\0'.encode())
+	digest.update(data)
+	return digest.hexdigest()
+
+
+class result_cache:
+	def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+		if path is None:
+			path = os.path.join(cache_dir(), CACHE_FILE_NAME)
+		if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+			os.makedirs(os.path.dirname(os.path.abspath(path)))
+		self.path = path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		# not yet written: {namespace: [hits, misses]}, {key: last use time}
+		self._counts = {}
+		self._used = {}
+		self._pending = 0
+		# estimate of the size of the file, only summed again when it passes max_bytes
+		self._size = None
+		atexit.register(self.flush)
+
+	@property
+	def connection(self):
+		# sqlite connections must not cross a fork or a thread, every worker opens its own
+		local = self._local
+		if getattr(local, 'pid', None) != os.getpid():
+			local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			local.connection.execute('PRAGMA journal_mode=WAL')
+			local.connection.execute('CREATE TABLE IF NOT EXISTS entries '
+									 '(key TEXT PRIMARY KEY, namespace TEXT, value BLOB, size INTEGER, last_used REAL)')
+			local.connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+			local.connection.execute('CREATE TABLE IF NOT EXISTS counters '
+									 '(namespace TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+			local.pid = os.getpid()
+		return local.connection
+
+	def _count(self, namespace, key, hit):
+		with self._lock:
+			counts = self._counts.setdefault(namespace, [0, 0])
+			counts[0 if hit else 1] += 1
+			if hit:
+				self._used[key] = time.time()
+			self._pending += 1
+			flush = self._pending >= FLUSH_EVERY
+		if flush:
+			self.flush()
+
+	def flush(self):
+		"""
+		writes the counters and use times gathered since the last flush.
+		"""
+		with self._lock:
+			counts, used = self._counts, self._used
+			self._counts, self._used, self._pending = {}, {}, 0
+		if not counts:
+			return
+		try:
+			with self.connection:
+				self.connection.execute('BEGIN')
+				for namespace, (hits, misses) in counts.items():
+					self.connection.execute('INSERT OR IGNORE INTO counters VALUES (?, 0, 0)', (namespace,))
+					self.connection.execute('UPDATE counters SET hits = hits + ?, misses = misses + ? WHERE namespace = ?',
+											(hits, misses, namespace))
+				self.connection.executemany('UPDATE entries SET last_used = ? WHERE key = ?',
+											[(last_used, key) for key, last_used in used.items()])
+		except sqlite3.Error as e:
+			logger.warning(f'could not write the cache counters to {self.path}: {e}')
+
+	def get(self, namespace, version, data):
+		"""
+		returns the cached bytes for the input, or None.
+		"""
+		key = cache_key(namespace, version, data)
+		row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+		if row is None:
+			self.misses += 1
+			self._count(namespace, key, hit=False)
+			return None
+		self.hits += 1
+		self._count(namespace, key, hit=True)
+		return row[0]
+
+	def put(self, namespace, version, data, value):
+		if isinstance(value, str):
+			value = value.encode()
+		key = cache_key(namespace, version, data)
+		self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+								(key, namespace, value, len(value), time.time()))
+		with self._lock:
+			if self._size is None:
+				self._size = self.size()
+			else:
+				self._size += len(value)
+			full = self._size > self.max_bytes
+		if full:
+			self.evict()
+
+	def size(self):
+		return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+	def evict(self):
+		"""
+		removes least recently used entries until the cache fits in max_bytes.
+		"""
+		size = self.size()
+		self._size = size
+		excess = size - self.max_bytes
+		if excess <= 0:
+			return
+		freed = 0
+		keys = []
+		for key, entry_size in self.connection.execute('SELECT key, size FROM entries ORDER BY last_used'):
+			keys.append((key,))
+			freed += entry_size
+			if freed >= excess:
+				break
+		self.connection.executemany('DELETE FROM entries WHERE key = ?', keys)
+		self._size = size - freed
+		logger.info(f'evicted {len(keys)} cache entries ({freed} bytes)')
+
+	def counters(self):
+		"""
+		{namespace: (hits, misses)} over all processes that used the cache file.
+		"""
+		self.flush()
+		return {namespace: (hits, misses) for namespace, hits, misses
+				in self.connection.execute('SELECT namespace, hits, misses FROM counters')}
+
+	def clear(self):
+		with self._lock:
+			self._counts, self._used, self._pending = {}, {}, 0
+		self.connection.execute('DELETE FROM entries')
+		self.connection.execute('DELETE FROM counters')
+		self._size = 0
+
+
+_cache = None
+
+
+def get_cache():
+	"""
+	the process wide cache, or None when caching is disabled (SPARTA_CACHE=0).
+	"""
+	global _cache
+	if os.environ.get("SPARTA_CACHE", "1") == "0":
+		return None
+	if _cache is None:
+		_cache = result_cache()
+	return _cache
+
+
+def cached(namespace, version, data, compute, encode=lambda value: value, decode=lambda value: value):
+	"""
+	returns decode(cached bytes) for the input, or computes, stores and returns compute().
+	Nothing is stored when compute raises or its encoded result is empty.
+	"""
+	cache = get_cache()
+	if cache is None:
+		return compute()
+	value = cache.get(namespace, version, data)
+	if value:
+		return decode(value)
+	result = compute()
+	value = encode(result)
+	if value:
+		cache.put(namespace, version, data, value)
+	else:
+		logger.warning(f'empty {namespace} result, not cached')
+	return result
+
+
+if __name__ == "__main__":
+	cache = result_cache()
+	if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+		cache.clear()
+	print(f'{cache.path}: {cache.size()} bytes')
+	for namespace, (hits, misses) in cache.counters().items():
+		print(f'{namespace}\thits {hits}\tmisses {misses}')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Binary columnar shards of generated training samples.
+
+A shard is a directory holding
+	meta.json             - number of samples, number of sequences per sample, column names
+	stats.npy             - (num_samples, num_stats) float32 summary statistics
+	params.npy            - (num_samples, num_params) float32 indel parameters, one column per parameter
+	trees.bin, trees.idx.npy - Newick trees, concatenated, with int64 offsets
+	rows.bin, rows.idx.npy   - aligned rows (num_seqs per sample), concatenated, with int64 offsets
+
+shard_reader memory-maps all of it, so random access never parses text.
+The text shards of the generators (all_data_<start>_<end>) convert with convert_text_shard.
+
+usage: python sample_shards.py <text_shard> [<text_shard> ...]
+"""
+
+import os
+import sys
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS, PARAMS_COLS
+
+
+SHARD_SUFFIX = '.shard'
+
+
+class shard_writer:
+	"""
+	appends samples to a binary shard. Call close() (or use as a context manager) to finalize it.
+	"""
+	def __init__(self, shard_path, num_seqs, params_cols=PARAMS_COLS, stats_cols=SUMMARY_STATS_COLS):
+		self.shard_path = shard_path
+		self.num_seqs = num_seqs
+		self.params_cols = list(params_cols)
+		self.stats_cols = list(stats_cols)
+		if not os.path.isdir(shard_path):
+			os.makedirs(shard_path)
+		self._trees = open(os.path.join(shard_path, 'trees.bin'), 'wb')
+		self._rows = open(os.path.join(shard_path, 'rows.bin'), 'wb')
+		self._tree_offsets = [0]
+		self._row_offsets = [0]
+		self._params = []
+		self._stats = []
+
+	def write(self, params, stats, tree, rows):
+		"""
+		params and stats are sequences of numbers (or their string forms), rows the aligned sequences.
+		"""
+		if len(rows) != self.num_seqs:
+			raise ValueError(f"Error: expected {self.num_seqs} rows, got {len(rows)}.")
+		self._params.append(params)
+		self._stats.append(stats)
+		tree = tree.encode()
+		self._trees.write(tree)
+		self._tree_offsets.append(self._tree_offsets[-1] + len(tree))
+		for row in rows:
+			row = row.encode()
+			self._rows.write(row)
+			self._row_offsets.append(self._row_offsets[-1] + len(row))
+
+	def __len__(self):
+		return len(self._params)
+
+	def close(self):
+		self._trees.close()
+		self._rows.close()
+		num_samples = len(self._params)
+		params = np.array(self._params, dtype=np.float32).reshape(num_samples, len(self.params_cols))
+		stats = np.array(self._stats, dtype=np.float32).reshape(num_samples, len(self.stats_cols))
+		np.save(os.path.join(self.shard_path, 'params.npy'), params)
+		np.save(os.path.join(self.shard_path, 'stats.npy'), stats)
+		np.save(os.path.join(self.shard_path, 'trees.idx.npy'), np.array(self._tree_offsets, dtype=np.int64))
+		np.save(os.path.join(self.shard_path, 'rows.idx.npy'), np.array(self._row_offsets, dtype=np.int64))
+		with open(os.path.join(self.shard_path, 'meta.json'), 'w') as f:
+			json.dump({'num_samples': num_samples,
+					   'num_seqs': self.num_seqs,
+					   'params_cols': self.params_cols,
+					   'stats_cols': self.stats_cols}, f)
+		logger.info(f'wrote {num_samples} samples to {self.shard_path}')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+def _memmap_bytes(path):
+	if os.path.getsize(path) == 0:
+		return np.zeros(0, dtype=np.uint8)
+	return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class shard_reader:
+	"""
+	memory-mapped random access to a binary shard.
+	"""
+	def __init__(self, shard_path):
+		self.shard_path = shard_path
+		with open(os.path.join(shard_path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.num_seqs = meta['num_seqs']
+		self.params_cols = meta['params_cols']
+		self.stats_cols = meta['stats_cols']
+		self.params = np.load(os.path.join(shard_path, 'params.npy'), mmap_mode='r')
+		self.stats = np.load(os.path.join(shard_path, 'stats.npy'), mmap_mode='r')
+		self._tree_offsets = np.load(os.path.join(shard_path, 'trees.idx.npy'), mmap_mode='r')
+		self._row_offsets = np.load(os.path.join(shard_path, 'rows.idx.npy'), mmap_mode='r')
+		self._trees = _memmap_bytes(os.path.join(shard_path, 'trees.bin'))
+		self._rows = _memmap_bytes(os.path.join(shard_path, 'rows.bin'))
+
+	def __len__(self):
+		return len(self.params)
+
+	def param(self, name):
+		return self.params[:, self.params_cols.index(name)]
+
+	def tree(self, i):
+		return self._trees[self._tree_offsets[i]:self._tree_offsets[i + 1]].tobytes().decode()
+
+	def rows(self, i):
+		offsets = self._row_offsets[i*self.num_seqs:(i + 1)*self.num_seqs + 1]
+		return [self._rows[start:end].tobytes().decode() for start, end in zip(offsets[:-1], offsets[1:])]
+
+	def rows_array(self, i):
+		"""
+		aligned rows of sample i as a (num_seqs, msa_len) uint8 array (rows of an msa share one length).
+		"""
+		start, end = self._row_offsets[i*self.num_seqs], self._row_offsets[(i + 1)*self.num_seqs]
+		return np.asarray(self._rows[start:end]).reshape(self.num_seqs, -1)
+
+	def __getitem__(self, i):
+		return {'params': self.params[i],
+				'stats': self.stats[i],
+				'tree': self.tree(i),
+				'rows': self.rows(i)}
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+
+def iter_text_shard(text_shard_path, num_seqs=10, num_params=len(PARAMS_COLS), num_stats=len(SUMMARY_STATS_COLS)):
+	"""
+	parses a generator text shard: per sample one line 'params,stats,tree' followed by num_seqs aligned rows.
+	Yields (params, stats, tree, rows).
+	"""
+	with open(text_shard_path) as f:
+		while True:
+			header = f.readline()
+			if not header:
+				return
+			# the tree itself contains commas
+			values = header.rstrip('\n').split(',', num_params + num_stats)
+			rows = [f.readline().rstrip('\n') for _ in range(num_seqs)]
+			yield values[:num_params], values[num_params:-1], values[-1], rows
+
+
+def convert_text_shard(text_shard_path, shard_path=None, num_seqs=10):
+	shard_path = text_shard_path + SHARD_SUFFIX if shard_path is None else shard_path
+	with shard_writer(shard_path, num_seqs) as writer:
+		for params, stats, tree, rows in iter_text_shard(text_shard_path, num_seqs):
+			writer.write(params, stats, tree, rows)
+	return shard_path
+
+
+if __name__ == "__main__":
+	for text_shard_path in sys.argv[1:]:
+		print(convert_text_shard(text_shard_path))
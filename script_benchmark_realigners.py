@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the realigner backends of the bias correction.
+
+True alignments are simulated with the native simulators (see generate_alignments),
+their sequences realigned by every available backend, and for each backend the
+report gives the wall time, the accuracy (sum-of-pairs score: the fraction of the
+residue pairs aligned in the true alignments that the realignments align too) and
+the drift of the summary statistics of the realignments from those of the true
+alignments (mean absolute and mean relative difference per statistic). Backends
+whose executable is missing are skipped.
+
+usage: python script_benchmark_realigners.py <report.json> [--num-msas 50] [--num-taxa 10] [--mode nuc] [--backends ...]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS
+import generate_alignments
+import msa_bias_corrector as corrector
+import realigners
+import summary_statistics as sstats
+
+
+EXECUTABLES = {'mafft': 'mafft', 'mafft_fast': 'mafft', 'mafft_accurate': 'mafft',
+			   'muscle': 'muscle', 'clustalw': 'clustalw2'}
+
+
+def simulate_true_msas(num_msas, num_taxa, mode, seed=0):
+	"""
+	returns (unaligned fasta texts, true aligned rows).
+	"""
+	settings = generate_alignments.get_parser().parse_args(
+		['--num-taxa', str(num_taxa), '--mode', mode, '--num-samples', str(num_msas), '--seed', str(seed),
+		 '--indel-simulator', 'native', '--substitution-simulator', 'native'])
+	names = [f'seq{i}' for i in range(num_taxa)]
+	unaligned_msas, true_msas = [], []
+	for _, _, _, rows in generate_alignments.generate_samples(settings, 0, num_msas):
+		unaligned_msas.append(realigners.to_fasta(names, [row.replace('-', '') for row in rows]))
+		true_msas.append(rows)
+	return unaligned_msas, true_msas
+
+
+def stats_drift(stats, true_stats):
+	abs_diff = np.abs(stats - true_stats)
+	rel_diff = abs_diff/np.maximum(np.abs(true_stats), 1)
+	return {name: {'mean_abs_diff': float(abs_diff[:, col].mean()),
+				   'mean_rel_diff': float(rel_diff[:, col].mean())}
+			for col, name in enumerate(SUMMARY_STATS_COLS)}
+
+
+def aligned_columns(row):
+	"""
+	column of every residue of an aligned row.
+	"""
+	return np.flatnonzero(np.frombuffer(row.encode(), dtype=np.uint8) != ord('-'))
+
+
+def sp_score(true_rows, rows):
+	"""
+	fraction of the residue pairs aligned in true_rows that rows align too.
+	"""
+	true_columns = [aligned_columns(row) for row in true_rows]
+	columns = [aligned_columns(row) for row in rows]
+	num_true_pairs, num_found_pairs = 0, 0
+	for i in range(len(true_rows)):
+		for j in range(i + 1, len(true_rows)):
+			# residue of j in every true column, then the true pairs (residue of i, residue of j)
+			true_j = np.full(len(true_rows[0]), -1)
+			true_j[true_columns[j]] = np.arange(len(true_columns[j]))
+			pair_j = true_j[true_columns[i]]
+			paired = pair_j >= 0
+			num_true_pairs += paired.sum()
+			num_found_pairs += (columns[i][paired] == columns[j][pair_j[paired]]).sum()
+	return float(num_found_pairs/num_true_pairs) if num_true_pairs else 1.0
+
+
+def benchmark(backends, unaligned_msas, true_msas, mode, num_workers=None):
+	true_stats = sstats.summary_stats_batch(true_msas)
+	res = {}
+	for name in backends:
+		start = time.perf_counter()
+		realigned_msas = corrector.reconstruct_msas(None, unaligned_msas, mode, num_workers, realigner_name=name)
+		seconds = time.perf_counter() - start
+		realigned_rows = [sstats.fasta_to_rows(msa) for msa in realigned_msas]
+		stats = sstats.summary_stats_batch(realigned_rows)
+		drift = stats_drift(stats, true_stats)
+		res[name] = {'seconds': seconds,
+					 'seconds_per_msa': seconds/len(unaligned_msas),
+					 'sp_score': float(np.mean([sp_score(true_rows, rows) for true_rows, rows in zip(true_msas, realigned_rows)])),
+					 'mean_rel_drift': float(np.mean([d['mean_rel_diff'] for d in drift.values()])),
+					 'drift': drift}
+		print(f"{name}: {res[name]['seconds_per_msa']*1e3:.1f} ms per msa, sp score {res[name]['sp_score']:.4f}, "
+			  f"mean relative drift {res[name]['mean_rel_drift']:.4f}")
+	return res
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Times the realigner backends and measures their accuracy and summary statistics drift.')
+	parser.add_argument('report_path')
+	parser.add_argument('--num-msas', type=int, default=50)
+	parser.add_argument('--num-taxa', type=int, default=10)
+	parser.add_argument('--mode', choices=['nuc', 'amino'], default='nuc')
+	parser.add_argument('--backends', nargs='+', default=list(realigners.REALIGNERS))
+	parser.add_argument('--num-workers', type=int, default=None)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	backends = []
+	for name in args.backends:
+		if name in EXECUTABLES and shutil.which(EXECUTABLES[name]) is None:
+			print(f'{EXECUTABLES[name]} not found, skipping {name}', file=sys.stderr)
+		else:
+			backends.append(name)
+
+	# realignments must be measured, not read back from the cache
+	os.environ["SPARTA_CACHE"] = "0"
+	unaligned_msas, true_msas = simulate_true_msas(args.num_msas, args.num_taxa, args.mode, args.seed)
+	report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			  'num_msas': args.num_msas,
+			  'num_taxa': args.num_taxa,
+			  'mode': args.mode,
+			  'seed': args.seed,
+			  'backends': benchmark(backends, unaligned_msas, true_msas, args.mode, args.num_workers)}
+	with open(args.report_path, 'w') as f:
+		json.dump(report, f, indent=1)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark and parity report of the summary statistics backends.
+
+Synthetic msas are drawn for every (number of sequences, msa length, gap density)
+of the grid, and summarized by every backend:
+	sparta_binary - the SpartaABC binary in _only_real_stats mode, one process per msa
+	in_process    - summary_statistics.summary_stats, one msa at a time
+	batched       - summary_statistics.summary_stats_batch, all msas of a grid point at once
+Each backend is timed, and its statistics are compared per statistic to the
+reference backend (the binary when it can run, in_process otherwise).
+The report is written as JSON, so runs can be tracked over time.
+
+usage: python script_benchmark_summary_statistics.py <report.json> [--num-msas 5] [--quick] [--sparta-exec path]
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS
+import msa_to_summary_statistics as mts
+import summary_statistics as sstats
+
+
+NUM_SEQS = [10, 100, 1000]
+MSA_LENS = [100, 1000, 10000]
+GAP_DENSITIES = [0.05, 0.2, 0.5]
+QUICK_GRID = ([10, 100], [100, 1000], [0.05, 0.5])
+MEAN_GAP_LENGTH = 3.0
+RTOL = 1e-5
+
+
+def synthetic_msa(num_seqs, msa_len, gap_density, rng, mean_gap_length=MEAN_GAP_LENGTH):
+	"""
+	(num_seqs, msa_len) uint8 msa whose rows alternate residue and gap runs of geometric lengths,
+	gap_density being the expected fraction of gaps. Every column keeps at least one residue.
+	"""
+	mean_residue_length = mean_gap_length*(1 - gap_density)/gap_density
+	num_runs = int(2*msa_len/(mean_gap_length + mean_residue_length)) + 10
+	msa = np.empty((num_seqs, msa_len), dtype=np.uint8)
+	for row in range(num_seqs):
+		while True:
+			residue_runs = rng.geometric(1/(mean_residue_length + 1), size=num_runs)
+			gap_runs = rng.geometric(1/mean_gap_length, size=num_runs)
+			if residue_runs.sum() + gap_runs.sum() >= msa_len:
+				break
+		runs = np.stack([residue_runs, gap_runs], axis=1).ravel()
+		states = np.tile([0, 1], num_runs)
+		# random phase, so rows do not all start with residues
+		offset = int(rng.integers(residue_runs[0] + gap_runs[0]))
+		gaps = np.repeat(states, runs)[offset:offset + msa_len]
+		msa[row] = np.where(gaps, sstats.GAP, ord('A'))
+	msa[rng.integers(num_seqs, size=msa_len), np.arange(msa_len)] = ord('A')
+	return msa
+
+
+def msa_to_fasta(msa):
+	return "".join(f'>{i}\n{row.tobytes().decode()}\n' for i, row in enumerate(msa))
+
+
+def run_sparta_binary(msas, sparta_exec_path):
+	return np.array([mts.sparta_stats_table(msa_to_fasta(msa), sparta_exec_path).split('\n')[2].split()[6:]
+					 for msa in msas], dtype=float)
+
+
+def run_in_process(msas, sparta_exec_path):
+	return np.array([sstats.summary_stats(msa) for msa in msas])
+
+
+def run_batched(msas, sparta_exec_path):
+	return sstats.summary_stats_batch(np.stack(msas))
+
+
+BACKENDS = {'sparta_binary': run_sparta_binary, 'in_process': run_in_process, 'batched': run_batched}
+
+
+def agreement(stats, reference):
+	"""
+	per statistic maximal absolute and relative differences to the reference.
+	"""
+	abs_diff = np.abs(stats - reference)
+	rel_diff = abs_diff/np.maximum(np.abs(reference), 1e-12)
+	res = {}
+	for col, name in enumerate(SUMMARY_STATS_COLS):
+		res[name] = {'max_abs_diff': float(abs_diff[:, col].max()),
+					 'max_rel_diff': float(rel_diff[:, col].max()),
+					 'agree': bool(np.allclose(stats[:, col], reference[:, col], rtol=RTOL, atol=0))}
+	return res
+
+
+def benchmark(grid, num_msas, backends, sparta_exec_path, seed=0):
+	rng = np.random.default_rng(seed)
+	reference_backend = 'sparta_binary' if 'sparta_binary' in backends else 'in_process'
+	points = []
+	for num_seqs in grid[0]:
+		for msa_len in grid[1]:
+			for gap_density in grid[2]:
+				msas = [synthetic_msa(num_seqs, msa_len, gap_density, rng) for _ in range(num_msas)]
+				point = {'num_seqs': num_seqs, 'msa_len': msa_len, 'gap_density': gap_density,
+						 'num_msas': num_msas, 'timings': {}, 'agreement': {}}
+				results = {}
+				for name in backends:
+					start = time.perf_counter()
+					results[name] = BACKENDS[name](msas, sparta_exec_path)
+					seconds = time.perf_counter() - start
+					point['timings'][name] = {'seconds': seconds, 'seconds_per_msa': seconds/num_msas}
+				for name in backends:
+					if name != reference_backend:
+						point['agreement'][name] = agreement(results[name], results[reference_backend])
+				disagreeing = [f'{name}:{stat}' for name in point['agreement']
+							   for stat, res in point['agreement'][name].items() if not res['agree']]
+				point['all_agree'] = not disagreeing
+				timings = ", ".join(f"{name} {res['seconds_per_msa']*1e3:.2f} ms" for name, res in point['timings'].items())
+				print(f'{num_seqs} seqs x {msa_len} cols, gap density {gap_density}: {timings}'
+					  + (f' DISAGREE {disagreeing}' if disagreeing else ''))
+				points.append(point)
+	return {'reference_backend': reference_backend, 'points': points}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Times the summary statistics backends and checks their agreement.')
+	parser.add_argument('report_path')
+	parser.add_argument('--num-msas', type=int, default=5, help='msas per grid point')
+	parser.add_argument('--quick', action='store_true', help='small grid, for a smoke test')
+	parser.add_argument('--sparta-exec', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SpartaABC'))
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	backends = list(BACKENDS)
+	if not os.access(args.sparta_exec, os.X_OK):
+		print(f'{args.sparta_exec} is not executable, skipping the sparta_binary backend')
+		backends.remove('sparta_binary')
+	grid = QUICK_GRID if args.quick else (NUM_SEQS, MSA_LENS, GAP_DENSITIES)
+
+	report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			  'host': platform.node(),
+			  'python': platform.python_version(),
+			  'numpy': np.__version__,
+			  'stats_version': sstats.STATS_VERSION,
+			  'backends': backends,
+			  'seed': args.seed}
+	report.update(benchmark(grid, args.num_msas, backends, args.sparta_exec, args.seed))
+	with open(args.report_path, 'w') as f:
+		json.dump(report, f, indent=1)
+	num_failed = sum(not point['all_agree'] for point in report['points'])
+	print(f'{len(report["points"]) - num_failed}/{len(report["points"])} grid points agree, report written to {args.report_path}')
+	sys.exit(1 if num_failed else 0)
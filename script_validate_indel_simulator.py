@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Statistical equivalence check of indel_simulator against the SpartaABC binary.
+
+Both simulators draw num_simulations alignments from the same priors along the
+same tree. The summary statistics of every alignment are compared per statistic
+with a two sample Kolmogorov-Smirnov test.
+
+usage: python script_validate_indel_simulator.py <tree_file> <seq_length> <num_simulations> <work_dir> [model_type] [alpha]
+"""
+
+import os
+import sys
+import subprocess
+import pandas as pd
+from scipy.stats import ks_2samp
+
+from configuration import get_sparta_config
+import indel_simulator as isim
+import msa_to_summary_statistics as mts
+
+
+def run_sparta_simulations(work_dir, sparta_exec_path, tree_path, seq_length, num_simulations,
+						   model_type, min_ir, max_ir, min_a, max_a):
+	"""
+	runs SpartaABC and returns the summary statistics of all its simulations.
+	"""
+	msa_path = os.path.join(work_dir, 'msa.fasta')
+	with open(msa_path, 'w') as f:
+		for name in isim.flatten_tree(isim.load_tree(tree_path))[3]:
+			f.write(f'>{name}\n{"A"*seq_length}\n')
+
+	sparta_config = get_sparta_config()
+	sparta_config["_inputRealMSAFile"] = msa_path
+	sparta_config["_inputTreeFileName"] = tree_path
+	sparta_config["_outputGoodParamsFile"] = os.path.join(work_dir, 'validation.posterior_params')
+	sparta_config["_outputAlignmnetsFile"] = os.path.join(work_dir, 'validation_alignments.fasta')
+	sparta_config["_alignments_output"] = "0"
+	sparta_config["_numSimulations"] = str(num_simulations)
+	sparta_config["_numberOfSamplesToKeep"] = str(num_simulations)
+	sparta_config["_numBurnIn"] = "1"
+	sparta_config["_modelType"] = model_type
+	sparta_config["_minIRVal"] = str(min_ir)
+	sparta_config["_maxIRVal"] = str(max_ir)
+	sparta_config["_minAVal"] = str(min_a)
+	sparta_config["_maxAVal"] = str(max_a)
+	conf_path = os.path.join(work_dir, 'validation.conf')
+	with open(conf_path, 'w') as fout:
+		for key in sparta_config:
+			fout.write(f'{key} {sparta_config[key]}\n')
+
+	subprocess.run([sparta_exec_path, conf_path], stdout=subprocess.DEVNULL)
+	df = pd.read_csv(sparta_config["_outputGoodParamsFile"], delimiter='\t',
+					 skiprows=[1, 2, 3], skipfooter=7, engine='python')
+	return df[df.columns[6:]]
+
+
+def run_native_simulations(work_dir, sparta_exec_path, tree_path, seq_length, num_simulations,
+						   model_type, min_ir, max_ir, min_a, max_a, columns):
+	"""
+	simulates with indel_simulator and summarizes every alignment with SpartaABC.
+	"""
+	with open(tree_path) as f:
+		tree = f.read().strip()
+	min_rl, max_rl = isim.rl_prior_from_msa(["A"*seq_length])
+	alignments, _ = isim.simulate_alignments(tree, num_simulations, model_type, min_rl, max_rl,
+											 min_ir, max_ir, min_a, max_a, seed=0)
+	rows = []
+	for alignment in alignments:
+		msa = alignment.strip().split('\n')[1::2]
+		rows.append([float(x) for x in mts.get_summary_stats(work_dir, msa, sparta_exec_path)])
+	return pd.DataFrame(rows, columns=columns)
+
+
+def compare(df_sparta, df_native, alpha=0.01):
+	res = []
+	for col in df_sparta.columns:
+		stat, p_value = ks_2samp(df_sparta[col].values, df_native[col].values)
+		res.append({'statistic': col,
+					'sparta_mean': df_sparta[col].mean(),
+					'native_mean': df_native[col].mean(),
+					'ks': stat,
+					'p_value': p_value,
+					'equivalent': p_value >= alpha})
+	return pd.DataFrame(res)
+
+
+if __name__ == "__main__":
+	tree_path = sys.argv[1]
+	seq_length = int(sys.argv[2])
+	num_simulations = int(sys.argv[3])
+	work_dir = sys.argv[4]
+	model_type = sys.argv[5] if len(sys.argv) > 5 else 'dif'
+	alpha = float(sys.argv[6]) if len(sys.argv) > 6 else 0.01
+
+	pipeline_path = os.path.dirname(os.path.abspath(__file__))
+	sparta_exec_path = os.path.join(pipeline_path, 'SpartaABC')
+	if not os.path.isdir(work_dir):
+		os.makedirs(work_dir)
+
+	priors = dict(min_ir=0, max_ir=0.05, min_a=1.001, max_a=2.0)
+	df_sparta = run_sparta_simulations(work_dir, sparta_exec_path, tree_path, seq_length,
+									   num_simulations, model_type, **priors)
+	df_native = run_native_simulations(work_dir, sparta_exec_path, tree_path, seq_length,
+									   num_simulations, model_type, columns=df_sparta.columns, **priors)
+	df_res = compare(df_sparta, df_native, alpha)
+	df_res.to_csv(os.path.join(work_dir, 'indel_simulator_validation.csv'), index=False)
+	print(df_res.to_string(index=False))
+	num_failed = int((~df_res['equivalent']).sum())
+	print(f'{len(df_res) - num_failed}/{len(df_res)} statistics equivalent at alpha={alpha}')
+	sys.exit(1 if num_failed else 0)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of substitution_simulator against closed forms.
+
+	1. P(t) of the JC model against 1/4 + 3/4 exp(-4t/3) (same state) and 1/4 - 1/4 exp(-4t/3)
+	2. the rows of every rate matrix (JC, GTR+I+G, WAG) sum to zero and P(t) converges to the frequencies
+	3. the fraction of differing sites between two JC sequences at distance t, simulated, against
+	   3/4 (1 - exp(-4t/3))
+
+usage: python script_validate_substitution_simulator.py [num_sites] [seed]
+"""
+
+import sys
+import numpy as np
+
+import substitution_simulator as subsim
+import generate_alignments
+
+
+TIMES = [0.01, 0.05, 0.1, 0.3, 0.5, 1.0, 2.0]
+
+
+def check_jc_transition_matrix():
+	model = subsim.model_from_submodel_params({"mode": "nuc", "submodel": "JC"})
+	failed = 0
+	for t in TIMES:
+		same = 0.25 + 0.75*np.exp(-4*t/3)
+		expected = np.full((4, 4), 0.25 - 0.25*np.exp(-4*t/3))
+		np.fill_diagonal(expected, same)
+		if not np.allclose(model.transition_matrix(t), expected, atol=1e-10):
+			failed += 1
+			print(f'JC P({t}): P_TT {model.transition_matrix(t)[0, 0]:.6f}, expected {same:.6f}')
+	return failed
+
+
+def check_stationary(name, model):
+	p = model.transition_matrix(100.0)
+	if not np.allclose(p, np.tile(model.freqs, (len(model.freqs), 1)), atol=1e-6):
+		print(f'{name}: P(t) does not converge to the frequencies')
+		return 1
+	return 0
+
+
+def check_jc_simulated_distance(num_sites, seed):
+	model = subsim.model_from_submodel_params({"mode": "nuc", "submodel": "JC"})
+	failed = 0
+	for t in TIMES:
+		msa, _ = model.simulate(f'(a:{t/2},b:{t/2});', num_sites, rng=seed)
+		observed = np.mean(msa[0, 0] != msa[0, 1])
+		expected = 0.75*(1 - np.exp(-4*t/3))
+		# 5 standard errors of a binomial proportion
+		if abs(observed - expected) > 5*np.sqrt(expected*(1 - expected)/num_sites):
+			failed += 1
+			print(f'JC distance {t}: {observed:.4f} differing sites, expected {expected:.4f}')
+	return failed
+
+
+if __name__ == "__main__":
+	num_sites = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+	models = {'JC': subsim.model_from_submodel_params({"mode": "nuc", "submodel": "JC"}),
+			  'GTR+I+G': subsim.model_from_submodel_params(dict(generate_alignments.SUBMODEL_PARAMS["nuc"], inv_prop=0.2)),
+			  'WAG': subsim.model_from_submodel_params(generate_alignments.SUBMODEL_PARAMS["amino"])}
+	num_failed = check_jc_transition_matrix()
+	num_failed += sum(check_stationary(name, model) for name, model in models.items())
+	num_failed += check_jc_simulated_distance(num_sites, seed)
+	print('all checks passed' if not num_failed else f'{num_failed} checks failed')
+	sys.exit(1 if num_failed else 0)
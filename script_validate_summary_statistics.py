@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Parity check of summary_statistics against the SpartaABC binary.
+
+Random msas (simulated with indel_simulator over random trees of 2 to 12 taxa,
+and random gap masks) are summarized by both. The binary prints 6 significant
+digits, so values are compared with a relative tolerance of 1e-5.
+The ragged batch of all msas (summary_stats_batch) must match msa by msa.
+
+usage: python script_validate_summary_statistics.py <num_msas> [sparta_exec_path] [seed]
+"""
+
+import os
+import sys
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS
+import tree_sampler
+import indel_simulator as isim
+import msa_to_summary_statistics as mts
+import summary_statistics as sstats
+
+
+def random_msas(num_msas, seed=0):
+	"""
+	yields msas as lists of rows.
+	"""
+	rng = np.random.default_rng(seed)
+	for i in range(num_msas):
+		num_taxa = int(rng.integers(2, 13))
+		if i % 2:
+			tree = tree_sampler.sample_tree(num_taxa, 0.02, 0.3, seed=rng.integers(1 << 31))
+			seq_length = int(rng.integers(20, 200))
+			alignments, _ = isim.simulate_alignments(tree, 1, 'dif', seq_length, seq_length,
+													 0, 0.1, 1.001, 2.0, seed=rng)
+			yield sstats.fasta_to_rows(alignments[0])
+		else:
+			# independent gap masks, with every column holding at least one residue
+			msa_len = int(rng.integers(5, 60))
+			gaps = rng.random((num_taxa, msa_len)) < rng.uniform(0.05, 0.6)
+			gaps[rng.integers(num_taxa, size=msa_len), np.arange(msa_len)] = False
+			yield ["".join('-' if gap else 'A' for gap in row) for row in gaps]
+
+
+if __name__ == "__main__":
+	num_msas = int(sys.argv[1])
+	pipeline_path = os.path.dirname(os.path.abspath(__file__))
+	sparta_exec_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(pipeline_path, 'SpartaABC')
+	seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+	msas = list(random_msas(num_msas, seed))
+	batch_stats = sstats.summary_stats_batch(msas, chunk_size=64)
+	num_failed = 0
+	for i, msa in enumerate(msas):
+		msa_text = "".join(f'>{idx}\n{seq}\n' for idx, seq in enumerate(msa))
+		expected = np.array(mts.sparta_stats_table(msa_text, sparta_exec_path).split('\n')[2].split()[6:], dtype=float)
+		computed = sstats.summary_stats(msa)
+		mismatches = ~np.isclose(computed, expected, rtol=1e-5, atol=0)
+		if not np.array_equal(batch_stats[i], computed):
+			print(f'msa {i}: batch statistics differ from single msa statistics')
+			mismatches |= True
+		if mismatches.any():
+			num_failed += 1
+			print(f'msa {i} ({len(msa)} sequences) differs:')
+			for col in np.flatnonzero(mismatches):
+				print(f'\t{SUMMARY_STATS_COLS[col]}: sparta {expected[col]} native {computed[col]}')
+	print(f'{num_msas - num_failed}/{num_msas} msas identical')
+	sys.exit(1 if num_failed else 0)
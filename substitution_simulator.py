@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+In-process substitution simulator, a drop-in alternative to INDELible for the
+models msa_bias_corrector configures through submodel_params:
+JC and GTR(+I+G) for nucleotides, WAG for amino acids.
+
+Transition matrices P(t) are computed once per (branch length, rate category)
+and whole alignment columns are drawn at once for every branch. With
+gamma_cats = 0 the gamma is continuous, as in INDELible: every site draws its
+own rate, and its P(t) rows are computed per site.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import stats
+from scipy import special
+
+import indel_simulator as isim
+
+
+# INDELible state orders.
+NUC_ALPHABET = 'TCAG'
+AMINO_ALPHABET = 'ARNDCQEGHILKMFPSTWYV'
+
+# WAG exchangeabilities (Whelan & Goldman 2001), lower triangle in AMINO_ALPHABET order.
+WAG_EXCHANGEABILITIES = """
+0.551571
+0.509848 0.635346
+0.738998 0.147304 5.42942
+1.02704 0.528191 0.265256 0.0302949
+0.908598 3.0355 1.54364 0.616783 0.0988179
+1.58285 0.439157 0.947198 6.17416 0.021352 5.46947
+1.41672 0.584665 1.12556 0.865584 0.306674 0.330052 0.567717
+0.316954 2.13715 3.95629 0.930676 0.248972 4.29411 0.570025 0.24941
+0.193335 0.186979 0.554236 0.039437 0.170135 0.113917 0.127395 0.0304501 0.13819
+0.397915 0.497671 0.131528 0.0848047 0.384287 0.869489 0.154263 0.0613037 0.499462 3.17097
+0.906265 5.35142 3.01201 0.479855 0.0740339 3.8949 2.58443 0.373558 0.890432 0.323832 0.257555
+0.893496 0.683162 0.198221 0.103754 0.390482 1.54526 0.315124 0.1741 0.404141 4.25746 4.85402 0.934276
+0.210494 0.102711 0.0961621 0.0467304 0.39802 0.0999208 0.0811339 0.049931 0.679371 1.05947 2.11517 0.088836 1.19063
+1.43855 0.679489 0.195081 0.423984 0.109404 0.933372 0.682355 0.24357 0.696198 0.0999288 0.415844 0.556896 0.171329 0.161444
+3.37079 1.22419 3.97423 1.07176 1.40766 1.02887 0.704939 1.34182 0.740169 0.31944 0.344739 0.96713 0.493905 0.545931 1.61328
+2.12111 0.554413 2.03006 0.374866 0.512984 0.857928 0.822765 0.225833 0.473307 1.45816 0.326622 1.38698 1.51612 0.171903 0.795384 4.37802
+0.113133 1.16392 0.0719167 0.129767 0.71707 0.215737 0.156557 0.336983 0.262569 0.212483 0.665309 0.137505 0.515706 1.52964 0.139405 0.523742 0.110864
+0.240735 0.381533 1.086 0.325711 0.543833 0.22771 0.196303 0.103604 3.87344 0.42017 0.398618 0.133264 0.428437 6.45428 0.216046 0.786993 0.291148 2.48539
+2.00601 0.251849 0.196246 0.152335 1.00214 0.301281 0.588731 0.187247 0.118358 7.8213 1.80034 0.305434 2.05845 0.649892 0.314887 0.232739 1.38823 0.365369 0.31473
+"""
+WAG_FREQS = (0.0866279, 0.043972, 0.0390894, 0.0570451, 0.0193078, 0.0367281, 0.0580589,
+			 0.0832518, 0.0244313, 0.048466, 0.086209, 0.0620286, 0.0195027, 0.0384319,
+			 0.0457631, 0.0695179, 0.0610127, 0.0143859, 0.0352742, 0.0708956)
+
+
+def wag_exchangeabilities():
+	exchangeabilities = np.zeros((20, 20))
+	for i, line in enumerate(WAG_EXCHANGEABILITIES.strip().split('\n')):
+		exchangeabilities[i + 1, :i + 1] = [float(x) for x in line.split()]
+	return exchangeabilities + exchangeabilities.T
+
+
+def gtr_exchangeabilities(rates):
+	"""
+	INDELible GTR parameters a..e (f = 1) in TCAG order:
+	a = TC, b = TA, c = TG, d = CA, e = CG, f = AG.
+	"""
+	a, b, c, d, e = rates
+	return np.array([[0, a, b, c],
+					 [a, 0, d, e],
+					 [b, d, 0, 1],
+					 [c, e, 1, 0]], dtype=float)
+
+
+def check_gamma_shape(gamma_shape):
+	if not gamma_shape > 0:
+		raise ValueError(f"Error: gamma_shape must be positive, got {gamma_shape}.")
+
+
+def gamma_category_rates(gamma_shape, gamma_cats):
+	"""
+	mean rates of gamma_cats equal-probability categories of a mean-one gamma distribution (Yang 1994).
+	"""
+	check_gamma_shape(gamma_shape)
+	if gamma_cats < 1:
+		raise ValueError(f"Error: gamma_cats must be at least 1 for discrete gamma rates, got {gamma_cats}.")
+	bounds = stats.gamma.ppf(np.arange(gamma_cats + 1)/gamma_cats, gamma_shape, scale=1/gamma_shape)
+	cumulative = special.gammainc(gamma_shape + 1, bounds*gamma_shape)
+	cumulative[-1] = 1.0
+	return np.diff(cumulative)*gamma_cats
+
+
+class substitution_model:
+	"""
+	reversible substitution model with discrete rate categories. When gamma_shape is set, the rates of
+	the sites are also multiplied by per-site draws of a mean-one gamma distribution (continuous gamma).
+	"""
+	def __init__(self, alphabet, exchangeabilities, freqs, category_rates=(1.0,), category_probs=(1.0,),
+				 gamma_shape=None):
+		self.alphabet = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+		self.freqs = np.asarray(freqs, dtype=float)/np.sum(freqs)
+		self.category_rates = np.asarray(category_rates, dtype=float)
+		self.category_probs = np.asarray(category_probs, dtype=float)
+		if gamma_shape is not None:
+			check_gamma_shape(gamma_shape)
+		self.gamma_shape = gamma_shape
+
+		rate_matrix = np.asarray(exchangeabilities, dtype=float)*self.freqs[np.newaxis, :]
+		# only off-diagonal exchangeabilities are rates, the diagonal makes the rows sum to zero
+		np.fill_diagonal(rate_matrix, 0)
+		np.fill_diagonal(rate_matrix, -rate_matrix.sum(axis=1))
+		rate_matrix /= -np.dot(self.freqs, np.diag(rate_matrix))
+
+		# symmetric form of the reversible rate matrix
+		sqrt_freqs = np.sqrt(self.freqs)
+		eigenvalues, eigenvectors = np.linalg.eigh(rate_matrix*sqrt_freqs[:, np.newaxis]/sqrt_freqs[np.newaxis, :])
+		self._eigenvalues = eigenvalues
+		self._left = eigenvectors/sqrt_freqs[:, np.newaxis]
+		self._right = eigenvectors.T*sqrt_freqs[np.newaxis, :]
+		self._cumulative_cache = {}
+
+	def transition_matrix(self, t):
+		p = (self._left*np.exp(self._eigenvalues*t)) @ self._right
+		p = np.clip(p, 0, None)
+		return p/p.sum(axis=1, keepdims=True)
+
+	def cumulative_transition_matrix(self, branch_length, category):
+		"""
+		cumulative rows of P(branch_length * rate of category), cached.
+		"""
+		key = (branch_length, category)
+		if key not in self._cumulative_cache:
+			self._cumulative_cache[key] = np.cumsum(
+				self.transition_matrix(branch_length*self.category_rates[category]), axis=1)
+		return self._cumulative_cache[key]
+
+	def cumulative_transition_rows(self, states, branch_lengths):
+		"""
+		cumulative rows P(branch_lengths[i])[states[i]], one per site.
+		"""
+		p = (self._left[states]*np.exp(self._eigenvalues[np.newaxis, :]*branch_lengths[:, np.newaxis])) @ self._right
+		p = np.clip(p, 0, None)
+		return np.cumsum(p/p.sum(axis=1, keepdims=True), axis=1)
+
+	def _draw(self, cumulative, size, rng):
+		return np.minimum((rng.random((size, 1)) > cumulative).sum(axis=1), len(self.alphabet) - 1)
+
+	def simulate(self, tree, seq_length, num_msa=1, rng=None):
+		"""
+		simulates num_msa alignments of seq_length columns along the tree.
+		Returns a (num_msa, num_leaves, seq_length) uint8 array of characters and the leaf names.
+		"""
+		rng = np.random.default_rng(rng)
+		parents, lengths, leaves, names = isim.flatten_tree(isim.load_tree(tree))
+		num_cols = num_msa*seq_length
+
+		states = [None]*len(parents)
+		states[0] = self._draw(np.cumsum(self.freqs)[np.newaxis, :], num_cols, rng)
+		categories = self._draw(np.cumsum(self.category_probs)[np.newaxis, :], num_cols, rng)
+		category_cols = [np.flatnonzero(categories == c) for c in range(len(self.category_probs))]
+		site_rates = None
+		if self.gamma_shape is not None:
+			site_rates = rng.gamma(self.gamma_shape, 1/self.gamma_shape, num_cols)
+		for node in range(1, len(parents)):
+			parent_states = states[parents[node]]
+			node_states = np.empty(num_cols, dtype=np.int64)
+			for category, cols in enumerate(category_cols):
+				if self.category_rates[category] == 0:
+					node_states[cols] = parent_states[cols]
+					continue
+				if site_rates is None:
+					cumulative = self.cumulative_transition_matrix(lengths[node], category)[parent_states[cols]]
+				else:
+					cumulative = self.cumulative_transition_rows(
+						parent_states[cols], lengths[node]*self.category_rates[category]*site_rates[cols])
+				node_states[cols] = self._draw(cumulative, len(cols), rng)
+			states[node] = node_states
+
+		leaf_states = np.stack([states[leaf] for leaf in leaves]).reshape(len(leaves), num_msa, seq_length)
+		return self.alphabet[leaf_states.transpose(1, 0, 2)], names
+
+
+def model_from_submodel_params(submodel_params):
+	"""
+	builds the model INDELible would use for the same submodel_params
+	(see msa_bias_corrector.set_indelible_submodel).
+	"""
+	if submodel_params["mode"] == "amino":
+		return substitution_model(AMINO_ALPHABET, wag_exchangeabilities(), WAG_FREQS)
+
+	if submodel_params["submodel"] == "JC":
+		return substitution_model(NUC_ALPHABET, np.ones((4, 4)) - np.eye(4), np.ones(4))
+
+	inv_prop = float(submodel_params['inv_prop'])
+	if not 0 <= inv_prop < 1:
+		raise ValueError(f"Error: inv_prop must be in [0, 1), got {inv_prop}.")
+	gamma_shape = float(submodel_params['gamma_shape'])
+	gamma_cats = int(submodel_params['gamma_cats'])
+	# gamma_cats = 0 is a continuous gamma in INDELible
+	category_rates = gamma_category_rates(gamma_shape, gamma_cats) if gamma_cats else np.ones(1)
+	category_probs = np.full(len(category_rates), (1 - inv_prop)/len(category_rates))
+	category_rates = category_rates/(1 - inv_prop)
+	if inv_prop > 0:
+		category_rates = np.append(category_rates, 0.0)
+		category_probs = np.append(category_probs, inv_prop)
+	return substitution_model(NUC_ALPHABET, gtr_exchangeabilities(submodel_params['rates']),
+							  submodel_params['freq'], category_rates, category_probs,
+							  gamma_shape=None if gamma_cats else gamma_shape)
+
+
+def msa_array_to_fasta(msa, names):
+	return "".join(f'>{name}\n{row.tobytes().decode()}\n' for name, row in zip(names, msa))
+
+
+def simulate_substitutions(tree, seq_length, num_msa, submodel_params, seed=None, model=None):
+	"""
+	simulates num_msa substitution msas along the tree.
+	Returns the msas as fasta strings, like msa_bias_corrector.run_indelible.
+	"""
+	model = model_from_submodel_params(submodel_params) if model is None else model
+	msas, names = model.simulate(tree, seq_length, num_msa, rng=seed)
+	logger.info(f'simulated {num_msa} substitution msas of length {seq_length}')
+	return [msa_array_to_fasta(msa, names) for msa in msas]
+
+
+def simulate_substitutions_batch(trees, seq_lengths, submodel_params, seed=None):
+	"""
+	simulates one substitution msa per (tree, length) pair, sharing a single model and its P(t) cache.
+	"""
+	rng = np.random.default_rng(seed)
+	model = model_from_submodel_params(submodel_params)
+	return [simulate_substitutions(tree, seq_length, 1, submodel_params, rng, model)[0]
+			for tree, seq_length in zip(trees, seq_lengths)]
+
+
+def simulate_substitutions_indexed(tree, seq_length, indices, submodel_params, seed):
+	"""
+	simulates one substitution msa per index, msa i drawn from its own stream (SeedSequence(seed, spawn_key=(i,))),
+	so the msa of an index does not depend on which other indices are simulated with it.
+	"""
+	model = model_from_submodel_params(submodel_params)
+	fastas = []
+	for index in indices:
+		msas, names = model.simulate(tree, seq_length, 1, rng=np.random.SeedSequence(seed, spawn_key=(index,)))
+		fastas.append(msa_array_to_fasta(msas[0], names))
+	logger.info(f'simulated {len(fastas)} substitution msas of length {seq_length}')
+	return fastas
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+In-process computation of the SpartaABC summary statistics of an msa.
+
+The msa is held as a (num_seqs, msa_len) uint8 matrix. Gaps are the maximal
+runs of '-' in a row, found from the edges of the padded gap mask. A unique gap
+is a (start, end) pair, shared by all the rows holding exactly that run.
+The statistics follow configuration.SUMMARY_STATS_COLS, so a vector can stand
+in for a row of a SpartaABC stats / posterior_params file.
+
+summary_stats_batch handles stacks of msas in a single pass, the gap runs of
+all msas being found at once and aggregated per msa with bincount.
+"""
+
+import numpy as np
+
+from configuration import SUMMARY_STATS_COLS
+
+
+# bump when the statistics change, stored statistics are keyed by it (see realignment_store, correction_models)
+STATS_VERSION = '1'
+GAP = ord('-')
+# fills the unused rows and columns of padded msa stacks
+PAD = 0
+# gap length bins of the NUM_GAPS_LEN_* statistics: 1, 2, 3 and at least 4.
+NUM_LENGTH_BINS = 4
+
+
+def fasta_to_rows(msa_text):
+	"""
+	aligned rows of a fasta text, sequences may span several lines.
+	"""
+	rows = []
+	for record in msa_text.split('>')[1:]:
+		_, _, sequence = record.partition('\n')
+		rows.append(sequence.replace('\n', '').replace('\r', ''))
+	return rows
+
+
+def msa_to_array(msa):
+	"""
+	(num_seqs, msa_len) uint8 matrix of an msa given as a list of rows or an array.
+	"""
+	if isinstance(msa, np.ndarray):
+		return msa if msa.dtype == np.uint8 else msa.astype(np.uint8)
+	msa_len = len(msa[0])
+	if any(len(row) != msa_len for row in msa):
+		raise ValueError("Error: msa rows have different lengths.")
+	return np.frombuffer("".join(msa).encode(), dtype=np.uint8).reshape(len(msa), msa_len)
+
+
+def stack_msas(msas):
+	"""
+	pads a ragged list of msas (lists of rows or 2D arrays) into a (batch, max_seqs, max_len) uint8 array.
+	Padding is PAD, so it is neither a gap nor a residue.
+	"""
+	msas = [msa_to_array(msa) for msa in msas]
+	max_seqs = max(msa.shape[0] for msa in msas)
+	max_len = max(msa.shape[1] for msa in msas)
+	batch = np.full((len(msas), max_seqs, max_len), PAD, dtype=np.uint8)
+	for i, msa in enumerate(msas):
+		batch[i, :msa.shape[0], :msa.shape[1]] = msa
+	return batch
+
+
+def gap_runs(gaps):
+	"""
+	msa indices, starts and (inclusive) ends of the runs of True along the last axis
+	of a (batch, seqs, cols) boolean array, in row major order.
+	"""
+	batch_size, num_seqs, msa_len = gaps.shape
+	padded = np.zeros((batch_size, num_seqs, msa_len + 2), dtype=np.int8)
+	padded[:, :, 1:-1] = gaps
+	edges = np.diff(padded, axis=2).ravel()
+	# flat indices are cheaper to find than 3D ones
+	run_starts = np.flatnonzero(edges == 1)
+	run_ends = np.flatnonzero(edges == -1)
+	return run_starts//(num_seqs*(msa_len + 1)), run_starts % (msa_len + 1), run_ends % (msa_len + 1) - 1
+
+
+def _count(msa_idx, batch_size, weights=None):
+	return np.bincount(msa_idx, weights=weights, minlength=batch_size)
+
+
+def _mean(msa_idx, values, batch_size):
+	counts = _count(msa_idx, batch_size)
+	return np.divide(_count(msa_idx, batch_size, values), counts, out=np.zeros(batch_size), where=counts > 0)
+
+
+def _summary_stats_stack(batch):
+	"""
+	statistics of a padded (batch, seqs, cols) uint8 array, one vectorized pass.
+	"""
+	batch_size, _, max_len = batch.shape
+	valid = batch != PAD
+	gaps = batch == GAP
+	seq_rows = valid.any(axis=2)
+	num_seqs = np.count_nonzero(seq_rows, axis=1)
+	msa_lens = np.count_nonzero(valid.any(axis=1), axis=1)
+
+	msa_idx, starts, ends = gap_runs(gaps)
+	lengths = ends - starts + 1
+	length_bins = np.minimum(lengths, NUM_LENGTH_BINS)
+
+	# unique gaps are identical (msa, start, end) triplets
+	keys = (msa_idx*(max_len + 1) + starts)*(max_len + 1) + ends
+	unique_keys, unique_counts = np.unique(keys, return_counts=True)
+	unique_idx = unique_keys//(max_len + 1)**2
+	unique_lengths = unique_keys % (max_len + 1) - unique_keys//(max_len + 1) % (max_len + 1) + 1
+	unique_bins = np.minimum(unique_lengths, NUM_LENGTH_BINS)
+
+	seq_lengths = np.count_nonzero(valid, axis=2) - np.count_nonzero(gaps, axis=2)
+	column_gaps = np.where(valid.any(axis=1), np.count_nonzero(gaps, axis=1), -1)
+	n_minus_1 = (num_seqs - 1)[:, np.newaxis]
+
+	stats = np.zeros((batch_size, len(SUMMARY_STATS_COLS)))
+	stats[:, 0] = _mean(msa_idx, lengths, batch_size)
+	stats[:, 1] = msa_lens
+	stats[:, 2] = np.where(seq_rows, seq_lengths, -1).max(axis=1)
+	stats[:, 3] = np.where(seq_rows, seq_lengths, max_len + 1).min(axis=1)
+	stats[:, 4] = _count(msa_idx, batch_size)
+	for length_bin in range(1, NUM_LENGTH_BINS + 1):
+		stats[:, 4 + length_bin] = _count(msa_idx[length_bins == length_bin], batch_size)
+	stats[:, 9] = _mean(unique_idx, unique_lengths, batch_size)
+	stats[:, 10] = _count(unique_idx, batch_size)
+	for length_bin in range(1, NUM_LENGTH_BINS + 1):
+		in_bin = unique_bins == length_bin
+		col = 11 + 3*(length_bin - 1)
+		stats[:, col] = _count(unique_idx[in_bin & (unique_counts == 1)], batch_size)
+		stats[:, col + 1] = _count(unique_idx[in_bin & (unique_counts == 2)], batch_size)
+		stats[:, col + 2] = _count(unique_idx[in_bin & (unique_counts == num_seqs[unique_idx] - 1)], batch_size)
+	stats[:, 23] = (column_gaps == 0).sum(axis=1)
+	stats[:, 24] = (column_gaps == 1).sum(axis=1)
+	stats[:, 25] = (column_gaps == 2).sum(axis=1)
+	# SpartaABC tests the column counts in turn, a column of n - 1 <= 2 gaps is only counted once
+	stats[:, 26] = np.where(n_minus_1[:, 0] > 2, (column_gaps == n_minus_1).sum(axis=1), 0)
+	return stats
+
+
+def summary_stats_batch(msas, chunk_size=10000):
+	"""
+	returns the summary statistics of many msas as a (batch, num_stats) float array in SUMMARY_STATS_COLS order.
+	msas is either a (batch, seqs, cols) uint8 array, padded with PAD, or a ragged list of msas
+	(lists of rows or 2D arrays). Msas are processed chunk_size at a time to bound memory.
+	"""
+	if isinstance(msas, np.ndarray) and msas.ndim == 3:
+		chunks = (msas[i:i + chunk_size] for i in range(0, len(msas), chunk_size))
+	else:
+		chunks = (stack_msas(msas[i:i + chunk_size]) for i in range(0, len(msas), chunk_size))
+	stats = [_summary_stats_stack(chunk) for chunk in chunks]
+	return np.concatenate(stats) if stats else np.zeros((0, len(SUMMARY_STATS_COLS)))
+
+
+def summary_stats(msa):
+	"""
+	returns the summary statistics of the msa as a float vector in SUMMARY_STATS_COLS order.
+	"""
+	return summary_stats_batch([msa])[0]
+
+
+def format_stats(stats):
+	"""
+	statistics as the strings SpartaABC prints (6 significant digits).
+	"""
+	return [f'{value:g}' for value in stats]
+
+
+def summary_stats_dict(msa):
+	return dict(zip(SUMMARY_STATS_COLS, summary_stats(msa)))
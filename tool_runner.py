@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Invocation layer for the external tools of the pipeline (MAFFT, SpartaABC, INDELible).
+
+Inputs are passed over stdin wherever the tool accepts it and outputs are read
+from stdout. Tools that insist on files get a private scratch directory on
+tmpfs ('/dev/shm' when available, or $SPARTA_SCRATCH_DIR), removed as soon as
+the call returns, so nothing touches the results directory. A tool exiting with
+a non-zero code raises tool_error, which carries its stderr.
+"""
+
+import os
+import tempfile
+import subprocess
+import functools
+import logging
+from contextlib import contextmanager
+logger = logging.getLogger(__name__)
+
+
+def scratch_root():
+	root = os.environ.get("SPARTA_SCRATCH_DIR")
+	if root:
+		return root
+	if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+		return '/dev/shm'
+	return tempfile.gettempdir()
+
+
+@contextmanager
+def scratch_dir(prefix='sparta_'):
+	"""
+	yields a fresh scratch directory path (with trailing separator), removed on exit.
+	"""
+	with tempfile.TemporaryDirectory(prefix=prefix, dir=scratch_root()) as path:
+		yield os.path.join(path, '')
+
+
+class tool_error(subprocess.CalledProcessError):
+	"""
+	a tool exited with a non-zero code (or was killed), stderr holds what it reported.
+	"""
+	def __str__(self):
+		return f"{super().__str__()}\n{(self.stderr or '').strip()[-2000:]}"
+
+
+def run_tool(args, input_text=None, cwd=None, capture_output=True, env=None):
+	"""
+	runs args (a list, no shell) feeding input_text on stdin. Returns stdout as text.
+	env entries are added to the environment of the tool. Raises tool_error when the tool fails.
+	"""
+	logger.debug(f'Running {" ".join(args)}')
+	if env is not None:
+		env = {**os.environ, **env}
+	result = subprocess.run(args, input=input_text, cwd=cwd, text=True, env=env,
+							stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+							stderr=subprocess.PIPE)
+	if result.returncode:
+		raise tool_error(result.returncode, args, output=result.stdout, stderr=result.stderr)
+	return result.stdout
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(executable, version_flag='--version'):
+	"""
+	version banner of a tool (stdout and stderr), 'unknown' when it cannot be run.
+	"""
+	try:
+		result = subprocess.run([executable, version_flag], text=True,
+								stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	except OSError:
+		return 'unknown'
+	return result.stdout.strip()
+
+
+def run_mafft(unaligned_msa, align_mode, extra_args=('--auto',), mafft_exec='mafft'):
+	"""
+	aligns the unaligned fasta text with MAFFT, reading it from stdin.
+	MAFFT keeps its temporary files in a scratch directory of its own, so calls can run concurrently.
+	"""
+	with scratch_dir('mafft_') as path:
+		return run_tool([mafft_exec, *extra_args, f'--{align_mode}', '/dev/stdin'], input_text=unaligned_msa,
+						cwd=path, env={'TMPDIR': path})
+
+
+def run_indelible(control_text, output_names, indelible_exec='indelible'):
+	"""
+	runs INDELible on the control text in a scratch directory.
+	Returns the content of '<output_name>.fas' for every output name.
+	"""
+	with scratch_dir('indelible_') as path:
+		with open(path + 'control.txt', 'w') as f:
+			f.write(control_text)
+		run_tool([indelible_exec], cwd=path, capture_output=False)
+		outputs = []
+		for output_name in output_names:
+			with open(f'{path}{output_name}.fas', 'r') as f:
+				outputs.append(f.read())
+	return outputs
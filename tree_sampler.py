@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Random rooted binary trees written directly as Newick strings.
+
+Topologies are built by joining random pairs of subtrees until one is left,
+branch lengths are drawn uniformly for all trees of a batch at once.
+A tree with N taxa has 2N-2 branches, like ete3's Tree.populate(N).
+"""
+
+import numpy as np
+
+
+def taxon_names(num_taxa):
+	"""
+	'A'..'Z', then 'AA', 'AB', ... (spreadsheet style), as many as needed.
+	"""
+	names = []
+	for i in range(num_taxa):
+		name = ""
+		i += 1
+		while i > 0:
+			i, rem = divmod(i - 1, 26)
+			name = chr(ord('A') + rem) + name
+		names.append(name)
+	return names
+
+
+def sample_trees(num_trees, num_taxa, min_branch_length, max_branch_length, seed=None, names=None):
+	"""
+	returns num_trees random Newick trees over num_taxa taxa.
+	"""
+	rng = np.random.default_rng(seed)
+	names = taxon_names(num_taxa) if names is None else names
+	num_merges = num_taxa - 1
+
+	branch_lengths = rng.uniform(min_branch_length, max_branch_length, size=(num_trees, 2*num_merges)).tolist()
+	# picks i from k subtrees and j from the k-1 remaining ones for every merge
+	pool_sizes = np.arange(num_taxa, 1, -1)
+	first = (rng.random((num_trees, num_merges))*pool_sizes).astype(np.int64).tolist()
+	second = (rng.random((num_trees, num_merges))*(pool_sizes - 1)).astype(np.int64).tolist()
+
+	trees = []
+	for tree_lengths, tree_first, tree_second in zip(branch_lengths, first, second):
+		subtrees = list(names)
+		for merge, (i, j) in enumerate(zip(tree_first, tree_second)):
+			left = subtrees.pop(i)
+			right = subtrees.pop(j)
+			subtrees.append(f'({left}:{tree_lengths[2*merge]},{right}:{tree_lengths[2*merge + 1]})')
+		trees.append(subtrees[0] + ';')
+	return trees
+
+
+def sample_tree(num_taxa, min_branch_length, max_branch_length, seed=None, names=None):
+	return sample_trees(1, num_taxa, min_branch_length, max_branch_length, seed, names)[0]